@@ -2,25 +2,121 @@
 # Slightly modified for Minion_Kadin#2022 (discord)
 # Please use the original plugin as this one may cause your bot to nuke the world
 
+import asyncio
+import datetime
+import heapq
+import itertools
+import math
+import time
+from collections import Counter
+
 import discord
 from discord.ext import commands
+from pymongo import ASCENDING, UpdateOne
 
 from core import checks
-from core.models import PermissionLevel
+from core.models import PermissionLevel, getLogger
 from core.utils import match_user_id
 
+logger = getLogger(__name__)
+
+WAIT_BUCKET_BASE = 1.25
+WAIT_BUCKETS = 100
+
 
 class ClaimThread(commands.Cog):
     """Allows supporters to claim thread by sending claim in the thread channel"""
     def __init__(self, bot):
         self.bot = bot
         self.db = bot.api.get_plugin_partition(self)
+        self.journal = self.db.database[f'{self.db.name}.journal']
+        self.claim_counts = None
+        self.migrated = False
+        self.assign_pool = None
+        self.assign_heap = []
+        self.assign_seq = itertools.count()
+        self.expiry_hours = 0
+        self.expiry_warn_hours = 0
+        self.expiry_deadlines = {}
+        self.stored_mentions = {}
+        self.expiry_heap = []
+        self.expiry_wakeup = asyncio.Event()
+        self.expiry_task = None
         check_reply.fail_msg = 'This thread has been claimed by another user.'
         self.bot.get_command('reply').add_check(check_reply)
         self.bot.get_command('areply').add_check(check_reply)
         self.bot.get_command('fareply').add_check(check_reply)
         self.bot.get_command('freply').add_check(check_reply)
 
+    async def cog_load(self):
+        await self.db.create_index([('guild', ASCENDING), ('thread_id', ASCENDING)])
+        await self.db.create_index('claimers')
+        await self.db.create_index('expires_at', sparse=True)
+        await self.journal.create_index([('thread_id', ASCENDING), ('at', ASCENDING)])
+        await self.journal.create_index([('supporter', ASCENDING), ('at', ASCENDING)])
+
+        migration = await self.db.find_one({'_id': 'migration'})
+        self.migrated = bool(migration and migration.get('int_ids'))
+        if not self.migrated:
+            self.bot.loop.create_task(self.migrate_claims())
+
+        config = await self.db.find_one({'_id': 'config'}) or {}
+        await self.journal.create_index('at', expireAfterSeconds=config.get('journal_days', 90) * 86400)
+        self.expiry_hours = config.get('expiry_hours', 0)
+        self.expiry_warn_hours = config.get('expiry_warn_hours', 0)
+        self.expiry_task = self.bot.loop.create_task(self.expiry_loop())
+        self.bot.loop.create_task(self.load_subscriptions())
+
+    def cog_unload(self):
+        if self.expiry_task:
+            self.expiry_task.cancel()
+
+    async def migrate_claims(self, batch_size=500):
+        """Convert claim documents from string ids to integer ids in batches"""
+        legacy = {'$or': [{'thread_id': {'$type': 'string'}}, {'guild': {'$type': 'string'}}, {'claimers': {'$type': 'string'}}]}
+        while True:
+            batch = await self.db.find(legacy).limit(batch_size).to_list(None)
+            if not batch:
+                break
+
+            # the filter pins the values the update was computed from, a document
+            # changed in the meantime is not matched and is read again next batch
+            requests = []
+            for x in batch:
+                query = {'_id': x['_id']}
+                update = {}
+                if 'thread_id' in x:
+                    query['thread_id'] = x['thread_id']
+                    update['thread_id'] = int(x['thread_id'])
+                if 'guild' in x:
+                    query['guild'] = x['guild']
+                    update['guild'] = int(x['guild'])
+                if 'claimers' in x:
+                    query['claimers'] = x['claimers']
+                    update['claimers'] = list(dict.fromkeys(int(c) for c in x['claimers']))
+                requests.append(UpdateOne(query, {'$set': update}))
+
+            await self.db.bulk_write(requests, ordered=False)
+            await asyncio.sleep(0)
+
+        await self.db.find_one_and_update({'_id': 'migration'}, {'$set': {'int_ids': True}}, upsert=True)
+        self.migrated = True
+
+    def id_query(self, value):
+        """Match an id stored either as an integer or, before migration, as a string"""
+        if self.migrated:
+            return int(value)
+        return {'$in': [int(value), str(value)]}
+
+    def claim_filter(self, channel_id):
+        return {'guild': self.id_query(self.bot.modmail_guild.id), 'thread_id': self.id_query(channel_id)}
+
+    async def find_claim(self, channel_id):
+        thread = await self.db.find_one(self.claim_filter(channel_id))
+        if thread:
+            thread['claimers'] = [int(c) for c in thread.get('claimers', [])]
+        return thread
+
     async def check_claimer(self, ctx, claimer_id):
         config = await self.db.find_one({'_id': 'config'})
         if config and 'limit' in config:
@@ -29,13 +125,366 @@ class ClaimThread(commands.Cog):
         else:
             raise commands.BadArgument(f"Set Limit first. `{ctx.prefix}claim limit`")
 
-        cursor = self.db.find({'guild':str(self.bot.modmail_guild.id)})
-        count = 0
+        if self.claim_counts is None:
+            await self.rebuild_claim_counts()
+
+        return self.claim_counts[int(claimer_id)] < config['limit']
+
+    async def rebuild_claim_counts(self):
+        """Recount active claims per claimer from the claim documents"""
+        counts = Counter()
+        cursor = self.db.find({'guild': self.id_query(self.bot.modmail_guild.id), 'claimers': {'$exists': True}}, {'claimers': 1})
         async for x in cursor:
-            if 'claimers' in x and str(claimer_id) in x['claimers']:
-                count += 1
+            for claimer in {int(c) for c in x['claimers']}:
+                counts[claimer] += 1
+
+        self.claim_counts = counts
+        self.assign_pool = None
+        return counts
+
+    def update_claim_counts(self, before, after):
+        """Apply the difference between two claimer lists to the claim counters"""
+        if self.claim_counts is None:
+            return
+
+        before = {int(c) for c in before or []}
+        after = {int(c) for c in after or []}
+        for claimer in before - after:
+            self.claim_counts[claimer] -= 1
+            if self.claim_counts[claimer] <= 0:
+                del self.claim_counts[claimer]
+            self.push_assign_load(claimer)
+        for claimer in after - before:
+            self.claim_counts[claimer] += 1
+            self.push_assign_load(claimer)
+
+    def reserve_claim_load(self, member_id, amount):
+        """Add to the claim counter of a member ahead of or after a claim write"""
+        self.claim_counts[member_id] += amount
+        if self.claim_counts[member_id] <= 0:
+            del self.claim_counts[member_id]
+        self.push_assign_load(member_id)
+
+    async def log_events(self, channel_id, event, supporters, claimers, by=None, wait=None):
+        """Append claim changes to the claim journal"""
+        now = discord.utils.utcnow()
+        events = []
+        for supporter in supporters:
+            x = {'thread_id': int(channel_id), 'supporter': int(supporter), 'event': event, 'by': by, 'at': now, 'claimers': claimers}
+            if wait is not None:
+                x['wait'] = wait
+            events.append(x)
+
+        if events:
+            await self.journal.insert_many(events, ordered=False)
+
+    async def add_claimer(self, channel_id, claimer_id, *, upsert=False, event=None, by=None):
+        now = discord.utils.utcnow()
+        update = {'$addToSet': {'claimers': int(claimer_id)}, '$min': {'first_claimed_at': now}}
+        if upsert:
+            update['$setOnInsert'] = {'thread_id': int(channel_id), 'guild': self.bot.modmail_guild.id}
+        before = await self.db.find_one_and_update(self.claim_filter(channel_id), update, upsert=upsert)
+        claimers = [int(c) for c in before['claimers']] if before else []
+        if before or upsert:
+            self.update_claim_counts(claimers, [*claimers, claimer_id])
+            if not claimers:
+                await self.schedule_expiry(channel_id)
+            if event and int(claimer_id) not in claimers:
+                wait = None
+                # tickets claimed before first_claimed_at was recorded have claimers
+                if not before or ('first_claimed_at' not in before and not before['claimers']):
+                    wait = (now - discord.utils.snowflake_time(int(channel_id))).total_seconds()
+                await self.log_events(channel_id, event, [claimer_id], [*claimers, int(claimer_id)], by, wait)
+        return before
+
+    async def remove_claimer(self, channel_id, claimer_id, *, event=None, by=None):
+        before = await self.db.find_one_and_update(
+            self.claim_filter(channel_id),
+            {'$pull': {'claimers': self.id_query(claimer_id)}},
+        )
+        if before:
+            after = [int(c) for c in before['claimers'] if int(c) != int(claimer_id)]
+            self.update_claim_counts(before['claimers'], after)
+            if before['claimers'] and not after:
+                await self.cancel_expiry(channel_id)
+            if event and len(after) != len(before['claimers']):
+                await self.log_events(channel_id, event, [claimer_id], after, by)
+        return before
+
+    async def set_claimers(self, channel_id, claimers, *, event=None, by=None):
+        claimers = [int(c) for c in claimers]
+        before = await self.db.find_one_and_update(self.claim_filter(channel_id), {'$set': {'claimers': claimers}})
+        if before:
+            self.update_claim_counts(before['claimers'], claimers)
+            if before['claimers'] and not claimers:
+                await self.cancel_expiry(channel_id)
+            elif claimers and not before['claimers']:
+                await self.schedule_expiry(channel_id)
+            if event:
+                changed = {int(c) for c in before['claimers']} ^ set(claimers)
+                await self.log_events(channel_id, event, changed, claimers, by)
+        return before
+
+    async def delete_claim(self, channel_id):
+        before = await self.db.find_one_and_delete(self.claim_filter(channel_id))
+        if before:
+            self.update_claim_counts(before.get('claimers'), [])
+            self.expiry_deadlines.pop(int(channel_id), None)
+            await self.drop_subscriptions([before])
+        return before
+
+    def push_expiry(self, channel_id, deadline, warned=False):
+        """Queue the warning and expiry of a claim in the expiry scheduler"""
+        self.expiry_deadlines[channel_id] = deadline
+        if self.expiry_warn_hours and not warned:
+            heapq.heappush(self.expiry_heap, (deadline - self.expiry_warn_hours * 3600, channel_id, 'warn', deadline))
+        heapq.heappush(self.expiry_heap, (deadline, channel_id, 'expire', deadline))
+        self.expiry_wakeup.set()
+
+    async def schedule_expiry(self, channel_id):
+        if not self.expiry_hours:
+            return
+
+        deadline = time.time() + self.expiry_hours * 3600
+        self.push_expiry(int(channel_id), deadline)
+        await self.db.update_one(self.claim_filter(channel_id), {'$set': {'expires_at': deadline, 'expiry_warned': False}})
+
+    async def cancel_expiry(self, channel_id):
+        if self.expiry_deadlines.pop(int(channel_id), None) is not None:
+            await self.db.update_one(self.claim_filter(channel_id), {'$unset': {'expires_at': '', 'expiry_warned': ''}})
+
+    async def load_expiry(self):
+        self.expiry_deadlines.clear()
+        self.expiry_heap = []
+        cursor = self.db.find({'expires_at': {'$exists': True}}, {'thread_id': 1, 'expires_at': 1, 'expiry_warned': 1})
+        async for x in cursor:
+            self.push_expiry(int(x['thread_id']), x['expires_at'], x.get('expiry_warned', False))
+
+    async def expiry_loop(self):
+        """Single scheduler that sleeps until the next claim warning or expiry is due"""
+        await self.bot.wait_until_ready()
+        await self.load_expiry()
+        while True:
+            self.expiry_wakeup.clear()
+            delay = self.expiry_heap[0][0] - time.time() if self.expiry_heap else None
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self.expiry_wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, channel_id, kind, deadline = heapq.heappop(self.expiry_heap)
+            if self.expiry_deadlines.get(channel_id) != deadline:
+                continue
+
+            try:
+                if kind == 'warn':
+                    await self.warn_expiry(channel_id)
+                else:
+                    await self.expire_claim(channel_id)
+            except Exception as e:
+                logger.error(f"Failed to process claim {kind} for {channel_id}: {e}")
+
+    async def warn_expiry(self, channel_id):
+        thread = await self.db.find_one_and_update(self.claim_filter(channel_id), {'$set': {'expiry_warned': True}})
+        channel = self.bot.modmail_guild.get_channel(channel_id)
+        if not (thread and channel):
+            return
+
+        mentions = ' '.join(f'<@{c}>' for c in thread.get('claimers', []))
+        embed = discord.Embed(
+            color=self.bot.main_color,
+            description=f"This claim expires <t:{int(self.expiry_deadlines[channel_id])}:R> unless a claimer replies.",
+        )
+        await channel.send(mentions, embed=embed)
+
+    async def expire_claim(self, channel_id):
+        self.expiry_deadlines.pop(channel_id, None)
+        await self.db.update_one(self.claim_filter(channel_id), {'$unset': {'expires_at': '', 'expiry_warned': ''}})
+        await self.set_claimers(channel_id, [], event='expired')
+
+        channel = self.bot.modmail_guild.get_channel(channel_id)
+        if channel:
+            embed = discord.Embed(
+                color=self.bot.main_color,
+                description=f"Claim expired after {self.expiry_hours} hours without a reply from the claimers.",
+            )
+            await channel.send(embed=embed)
+
+    def build_assign_pool(self, config):
+        """Collect auto assign candidates and heap them by active claims"""
+        pool = set()
+        for role_id in config.get('auto_roles', []):
+            role = self.bot.modmail_guild.get_role(role_id)
+            if role:
+                pool.update(m.id for m in role.members if not m.bot)
+
+        self.assign_pool = pool
+        self.assign_heap = [(self.claim_counts[m], next(self.assign_seq), m) for m in pool]
+        heapq.heapify(self.assign_heap)
+
+    def push_assign_load(self, member_id):
+        if self.assign_pool is None or member_id not in self.assign_pool:
+            return
+
+        heapq.heappush(self.assign_heap, (self.claim_counts[member_id], next(self.assign_seq), member_id))
+        if len(self.assign_heap) > 4 * len(self.assign_pool) + 16:
+            # drop outdated entries left behind by load changes
+            self.assign_heap = [(self.claim_counts[m], next(self.assign_seq), m) for m in self.assign_pool]
+            heapq.heapify(self.assign_heap)
+
+    async def pick_supporter(self, config, exclude=None):
+        """Pop the online, eligible supporter with the fewest active claims"""
+        if self.claim_counts is None:
+            await self.rebuild_claim_counts()
+        if self.assign_pool is None:
+            self.build_assign_pool(config)
+
+        limit = config.get('limit', 0)
+        bypass_roles = set(config.get('bypass_roles', []))
+        skipped = []
+        chosen = None
+        while self.assign_heap:
+            load, seq, member_id = heapq.heappop(self.assign_heap)
+            if member_id not in self.assign_pool or load != self.claim_counts[member_id]:
+                continue
+
+            skipped.append((load, seq, member_id))
+            if member_id == exclude:
+                continue
+            member = self.bot.modmail_guild.get_member(member_id)
+            if member is None or member.status == discord.Status.offline:
+                continue
+            if limit and load >= limit and not any(r.id in bypass_roles for r in member.roles):
+                continue
+
+            chosen = member
+            break
+
+        for entry in skipped:
+            heapq.heappush(self.assign_heap, entry)
+        return chosen
+
+    async def subscribe(self, thread, member):
+        """Subscribe a member to a thread, stored on the claim document"""
+        await self.db.update_one(
+            self.claim_filter(thread.channel.id),
+            {
+                '$addToSet': {'subscribers': member.id},
+                '$set': {'recipient': thread.id},
+                '$setOnInsert': {'thread_id': thread.channel.id, 'guild': self.bot.modmail_guild.id, 'claimers': []},
+            },
+            upsert=True,
+        )
+        mentions = self.bot.config["subscriptions"].setdefault(str(thread.id), [])
+        if member.mention not in mentions:
+            mentions.append(member.mention)
+
+    async def unsubscribe(self, thread, member):
+        await self.db.update_one(self.claim_filter(thread.channel.id), {'$pull': {'subscribers': member.id}})
+        await self.drop_subscriptions([{'recipient': thread.id, 'subscribers': [member.id]}])
+
+    async def drop_subscriptions(self, claims):
+        """
+        Remove the mentions of claim subscribers from the core subscriptions.
+
+        Other mentions, e.g. from the core subscribe command, are kept. The
+        core config is only written when a removed mention was also stored,
+        as far as known from the last load or write.
+        """
+        subscriptions = self.bot.config["subscriptions"]
+        removed = {}
+        for x in claims:
+            if x.get('recipient') is None or not x.get('subscribers'):
+                continue
+            key = str(x['recipient'])
+            owned = {f'<@{member_id}>' for member_id in x['subscribers']}
+            mentions = subscriptions.get(key)
+            if mentions:
+                mentions[:] = [m for m in mentions if m not in owned]
+                if not mentions:
+                    del subscriptions[key]
+            removed.setdefault(key, set()).update(owned)
+
+        if any(owned & self.stored_mentions.get(key, set()) for key, owned in removed.items()):
+            await self.save_subscriptions()
+
+    async def save_subscriptions(self):
+        """Write the core config and remember which mentions are now stored"""
+        await self.bot.config.update()
+        self.stored_mentions = {k: set(v) for k, v in self.bot.config["subscriptions"].items()}
+
+    async def prune_subscriptions(self):
+        """Remove subscriptions of closed threads from the core config in one update"""
+        cursor = self.bot.api.logs.find({'open': True}, {'recipient.id': 1})
+        open_threads = {str(x['recipient']['id']) async for x in cursor}
+
+        subscriptions = self.bot.config["subscriptions"]
+        closed = [k for k in subscriptions if k not in open_threads]
+        for k in closed:
+            del subscriptions[k]
+        if closed:
+            await self.save_subscriptions()
+        return len(closed)
+
+    async def load_subscriptions(self):
+        await self.bot.wait_until_ready()
+        await self.prune_subscriptions()
+
+        subscriptions = self.bot.config["subscriptions"]
+        # before the claim mentions are merged in, the core subscriptions match the stored config
+        self.stored_mentions = {k: set(v) for k, v in subscriptions.items()}
+        cursor = self.db.find({'subscribers.0': {'$exists': True}, 'recipient': {'$exists': True}}, {'recipient': 1, 'subscribers': 1})
+        async for x in cursor:
+            mentions = subscriptions.setdefault(str(x['recipient']), [])
+            for member_id in x['subscribers']:
+                if f'<@{member_id}>' not in mentions:
+                    mentions.append(f'<@{member_id}>')
+
+    async def delete_claims(self, claims):
+        """Delete many claim documents in one request"""
+        if not claims:
+            return
+
+        await self.db.delete_many({'_id': {'$in': [x['_id'] for x in claims]}})
+        for x in claims:
+            self.update_claim_counts(x.get('claimers'), [])
+            self.expiry_deadlines.pop(int(x['thread_id']), None)
+        await self.drop_subscriptions(claims)
+
+    async def resolve_claim_channels(self, guild, claims, concurrency=5):
+        """
+        Split claim documents into live channels and stale claims.
+
+        Channels are looked up in the guild cache first, only uncached ids
+        are fetched, at most `concurrency` at a time.
+        """
+        channels = {}
+        stale = []
+        missing = []
+        for x in claims:
+            channel = guild.get_channel(int(x['thread_id']))
+            if channel:
+                channels[channel.id] = channel
+            else:
+                missing.append(x)
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(x):
+            async with semaphore:
+                try:
+                    channel = await self.bot.fetch_channel(int(x['thread_id']))
+                except discord.NotFound:
+                    stale.append(x)
+                except discord.HTTPException:
+                    pass
+                else:
+                    channels[channel.id] = channel
 
-        return count < config['limit']
+        await asyncio.gather(*(fetch(x) for x in missing))
+        return channels, stale
 
     async def check_before_update(self, channel):
         if channel.guild != self.bot.modmail_guild or await self.bot.api.get_log(channel.id) is None:
@@ -46,7 +495,48 @@ class ClaimThread(commands.Cog):
     @commands.Cog.listener()
     async def on_guild_channel_delete(self, channel):
         if await self.check_before_update(channel):
-            await self.db.delete_one({'thread_id': str(channel.id), 'guild': str(self.bot.modmail_guild.id)})
+            await self.delete_claim(channel.id)
+
+    @commands.Cog.listener()
+    async def on_thread_ready(self, thread, creator, category, initial_message):
+        config = await self.db.find_one({'_id': 'config'})
+        if not (config and config.get('auto_assign')):
+            return
+
+        member = await self.pick_supporter(config)
+        if member is None:
+            return
+
+        # reserve the load before the write so threads opened meanwhile see it,
+        # add_claimer counts the claim itself once the write returns
+        counts = self.claim_counts
+        self.reserve_claim_load(member.id, 1)
+        try:
+            await self.add_claimer(thread.channel.id, member.id, upsert=True, event='auto_assigned')
+        finally:
+            if self.claim_counts is counts:
+                self.reserve_claim_load(member.id, -1)
+        await self.subscribe(thread, member)
+
+        embed = discord.Embed(
+            color=self.bot.main_color,
+            description=f"{member.mention} has been assigned to this thread and will be notified of all messages received.",
+        )
+        await thread.channel.send(embed=embed)
+
+    @commands.Cog.listener()
+    async def on_thread_reply(self, thread, from_mod, message, anonymous, plain):
+        if not from_mod or thread.channel.id not in self.expiry_deadlines:
+            return
+
+        claim = await self.find_claim(thread.channel.id)
+        if claim and message.author.id in claim['claimers']:
+            await self.schedule_expiry(thread.channel.id)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        if self.assign_pool is not None and before.roles != after.roles:
+            self.assign_pool = None
 
     @checks.has_permissions(PermissionLevel.SUPPORTER)
     @checks.thread_only()
@@ -57,7 +547,7 @@ class ClaimThread(commands.Cog):
             if not await self.check_claimer(ctx, ctx.author.id):
                 return await ctx.reply(f"Limit reached, can't claim the thread.")
 
-            thread = await self.db.find_one({'thread_id': str(ctx.thread.channel.id), 'guild': str(self.bot.modmail_guild.id)})
+            thread = await self.find_claim(ctx.thread.channel.id)
             recipient_id = match_user_id(ctx.thread.channel.topic)
             recipient = self.bot.get_user(recipient_id) or await self.bot.fetch_user(recipient_id)
 
@@ -72,28 +562,24 @@ class ClaimThread(commands.Cog):
 
             description = ""
             if subscribe:
-                if str(ctx.thread.id) not in self.bot.config["subscriptions"]:
-                    self.bot.config["subscriptions"][str(ctx.thread.id)] = []
-
-                mentions = self.bot.config["subscriptions"][str(ctx.thread.id)]
+                mentions = self.bot.config["subscriptions"].get(str(ctx.thread.id), [])
 
                 if ctx.author.mention in mentions:
-                    mentions.remove(ctx.author.mention)
+                    await self.unsubscribe(ctx.thread, ctx.author)
                     description += f"{ctx.author.mention} will __not__ be notified of any message now.\n"
                 else:
-                    mentions.append(ctx.author.mention)
+                    await self.subscribe(ctx.thread, ctx.author)
                     description += f"{ctx.author.mention} will now be notified of all messages received.\n"
-                await self.bot.config.update()
 
             if thread is None:
-                await self.db.insert_one({'thread_id': str(ctx.thread.channel.id), 'guild': str(self.bot.modmail_guild.id), 'claimers': [str(ctx.author.id)]})
+                await self.add_claimer(ctx.thread.channel.id, ctx.author.id, upsert=True, event='claimed', by=ctx.author.id)
                 async with ctx.typing():
                     await recipient.send(embed=embed)
                 description += "Please respond to the case asap."
                 embed.description = description
                 await ctx.reply(embed=embed)
             elif thread and len(thread['claimers']) == 0:
-                await self.db.find_one_and_update({'thread_id': str(ctx.thread.channel.id), 'guild': str(self.bot.modmail_guild.id)}, {'$addToSet': {'claimers': str(ctx.author.id)}})
+                await self.add_claimer(ctx.thread.channel.id, ctx.author.id, event='claimed', by=ctx.author.id)
                 async with ctx.typing():
                     await recipient.send(embed=embed)
                 description += "Please respond to the case asap."
@@ -108,18 +594,10 @@ class ClaimThread(commands.Cog):
     @commands.command()
     async def claims(self, ctx):
         """Check which channels you have clamined"""
-        cursor = self.db.find({'guild':str(self.bot.modmail_guild.id)})
-        channels = []
-        async for x in cursor:
-            if 'claimers' in x and str(ctx.author.id) in x['claimers']:
-                try:
-                    channel = ctx.guild.get_channel(int(x['thread_id'])) or await self.bot.fetch_channel(int(x['thread_id']))
-                except discord.NotFound:
-                    channel = None
-                    await self.db.delete_one({'thread_id': x['thread_id'], 'guild': x['guild']})
-
-                if channel and channel not in channels:
-                    channels.append(channel)
+        claims = await self.db.find({'guild': self.id_query(self.bot.modmail_guild.id), 'claimers': self.id_query(ctx.author.id)}).to_list(None)
+        channels, stale = await self.resolve_claim_channels(ctx.guild, claims)
+        await self.delete_claims(stale)
+        channels = channels.values()
 
         embed = discord.Embed(title='Your claimed tickets:', color=self.bot.main_color)
         embed.description = ', '.join(ch.mention for ch in channels)
@@ -129,17 +607,24 @@ class ClaimThread(commands.Cog):
     @claim_.command()
     async def cleanup(self, ctx):
         """Cleans up the database for deleted tickets"""
-        cursor = self.db.find({'guild':str(self.bot.modmail_guild.id)})
-        count = 0
-        async for x in cursor:
-            try:
-                channel = ctx.guild.get_channel(int(x['thread_id'])) or await self.bot.fetch_channel(int(x['thread_id']))
-            except discord.NotFound:
-                await self.db.delete_one({'thread_id': x['thread_id'], 'guild': x['guild']})
-                count += 1
+        claims = await self.db.find({'guild': self.id_query(self.bot.modmail_guild.id)}, {'thread_id': 1, 'claimers': 1, 'recipient': 1, 'subscribers': 1}).to_list(None)
+        _, stale = await self.resolve_claim_channels(ctx.guild, claims)
+        await self.delete_claims(stale)
+        count = len(stale)
+        pruned = await self.prune_subscriptions()
+
+        embed = discord.Embed(color=self.bot.main_color)
+        embed.description = f"Cleaned up {count} closed tickets records and {pruned} subscriptions"
+        await ctx.send(embed=embed)
+
+    @checks.has_permissions(PermissionLevel.MODERATOR)
+    @claim_.command(name='recount')
+    async def claim_recount(self, ctx):
+        """Rebuilds the active claim counters from the database"""
+        counts = await self.rebuild_claim_counts()
 
         embed = discord.Embed(color=self.bot.main_color)
-        embed.description = f"Cleaned up {count} closed tickets records"
+        embed.description = f"Recounted {sum(counts.values())} active claims for {len(counts)} claimers"
         await ctx.send(embed=embed)
 
     @checks.has_permissions(PermissionLevel.SUPPORTER)
@@ -149,19 +634,15 @@ class ClaimThread(commands.Cog):
         """Unclaim a thread"""
         embed = discord.Embed(color=self.bot.main_color)
         description = ""
-        thread = await self.db.find_one({'thread_id': str(ctx.thread.channel.id), 'guild': str(self.bot.modmail_guild.id)})
-        if thread and str(ctx.author.id) in thread['claimers']:
-            await self.db.find_one_and_update({'thread_id': str(ctx.thread.channel.id), 'guild': str(self.bot.modmail_guild.id)}, {'$pull': {'claimers': str(ctx.author.id)}})
+        thread = await self.find_claim(ctx.thread.channel.id)
+        if thread and ctx.author.id in thread['claimers']:
+            await self.remove_claimer(ctx.thread.channel.id, ctx.author.id, event='unclaimed', by=ctx.author.id)
             description += 'Removed from claimers.\n'
 
-        if str(ctx.thread.id) not in self.bot.config["subscriptions"]:
-            self.bot.config["subscriptions"][str(ctx.thread.id)] = []
-
-        mentions = self.bot.config["subscriptions"][str(ctx.thread.id)]
+        mentions = self.bot.config["subscriptions"].get(str(ctx.thread.id), [])
 
         if ctx.author.mention in mentions:
-            mentions.remove(ctx.author.mention)
-            await self.bot.config.update()
+            await self.unsubscribe(ctx.thread, ctx.author)
             description += f"{ctx.author.mention} is now unsubscribed from this thread."
 
         if description == "":
@@ -178,12 +659,12 @@ class ClaimThread(commands.Cog):
         if not await self.check_claimer(ctx, member.id):
             return await ctx.reply(f"Limit reached, can't claim the thread.")
 
-        thread = await self.db.find_one({'thread_id': str(ctx.thread.channel.id), 'guild': str(self.bot.modmail_guild.id)})
+        thread = await self.find_claim(ctx.thread.channel.id)
         if thread is None:
-            await self.db.insert_one({'thread_id': str(ctx.thread.channel.id), 'guild': str(self.bot.modmail_guild.id), 'claimers': [str(member.id)]})
+            await self.add_claimer(ctx.thread.channel.id, member.id, upsert=True, event='forced_claim', by=ctx.author.id)
             await ctx.send(f'{member.name} is added to claimers')
-        elif str(member.id) not in thread['claimers']:
-            await self.db.find_one_and_update({'thread_id': str(ctx.thread.channel.id), 'guild': str(self.bot.modmail_guild.id)}, {'$addToSet': {'claimers': str(member.id)}})
+        elif member.id not in thread['claimers']:
+            await self.add_claimer(ctx.thread.channel.id, member.id, event='forced_claim', by=ctx.author.id)
             await ctx.send(f'{member.name} is added to claimers')
         else:
             await ctx.send(f'{member.name} is already in claimers')
@@ -193,10 +674,10 @@ class ClaimThread(commands.Cog):
     @commands.command()
     async def forceunclaim(self, ctx, *, member: discord.Member):
         """Force remove a user from the thread claimers"""
-        thread = await self.db.find_one({'thread_id': str(ctx.thread.channel.id), 'guild': str(self.bot.modmail_guild.id)})
+        thread = await self.find_claim(ctx.thread.channel.id)
         if thread:
-            if str(member.id) in thread['claimers']:
-                await self.db.find_one_and_update({'thread_id': str(ctx.thread.channel.id), 'guild': str(self.bot.modmail_guild.id)}, {'$pull': {'claimers': str(member.id)}})
+            if member.id in thread['claimers']:
+                await self.remove_claimer(ctx.thread.channel.id, member.id, event='forced_unclaim', by=ctx.author.id)
                 await ctx.send(f'{member.name} is removed from claimers')
             else:
                 await ctx.send(f'{member.name} is not in claimers')
@@ -211,9 +692,9 @@ class ClaimThread(commands.Cog):
         if not await self.check_claimer(ctx, member.id):
             return await ctx.reply(f"Limit reached, can't claim the thread.")
 
-        thread = await self.db.find_one({'thread_id': str(ctx.thread.channel.id), 'guild': str(self.bot.modmail_guild.id)})
-        if thread and str(ctx.author.id) in thread['claimers']:
-            await self.db.find_one_and_update({'thread_id': str(ctx.thread.channel.id), 'guild': str(self.bot.modmail_guild.id)}, {'$addToSet': {'claimers': str(member.id)}})
+        thread = await self.find_claim(ctx.thread.channel.id)
+        if thread and ctx.author.id in thread['claimers']:
+            await self.add_claimer(ctx.thread.channel.id, member.id, event='claimed', by=ctx.author.id)
             await ctx.send('Added to claimers')
 
     @checks.has_permissions(PermissionLevel.SUPPORTER)
@@ -221,9 +702,9 @@ class ClaimThread(commands.Cog):
     @commands.command()
     async def removeclaim(self, ctx, *, member: discord.Member):
         """Removes a user from the thread claimers"""
-        thread = await self.db.find_one({'thread_id': str(ctx.thread.channel.id), 'guild': str(self.bot.modmail_guild.id)})
-        if thread and str(ctx.author.id) in thread['claimers']:
-            await self.db.find_one_and_update({'thread_id': str(ctx.thread.channel.id), 'guild': str(self.bot.modmail_guild.id)}, {'$pull': {'claimers': str(member.id)}})
+        thread = await self.find_claim(ctx.thread.channel.id)
+        if thread and ctx.author.id in thread['claimers']:
+            await self.remove_claimer(ctx.thread.channel.id, member.id, event='unclaimed', by=ctx.author.id)
             await ctx.send('Removed from claimers')
 
     @checks.has_permissions(PermissionLevel.SUPPORTER)
@@ -234,9 +715,9 @@ class ClaimThread(commands.Cog):
         if not await self.check_claimer(ctx, member.id):
             return await ctx.reply(f"Limit reached, can't claim the thread.")
 
-        thread = await self.db.find_one({'thread_id': str(ctx.thread.channel.id), 'guild': str(self.bot.modmail_guild.id)})
-        if thread and str(ctx.author.id) in thread['claimers']:
-            await self.db.find_one_and_update({'thread_id': str(ctx.thread.channel.id), 'guild': str(self.bot.modmail_guild.id)}, {'$set': {'claimers': [str(member.id)]}})
+        thread = await self.find_claim(ctx.thread.channel.id)
+        if thread and ctx.author.id in thread['claimers']:
+            await self.set_claimers(ctx.thread.channel.id, [member.id], event='transferred', by=ctx.author.id)
             await ctx.send('Added to claimers')
 
     @checks.has_permissions(PermissionLevel.MODERATOR)
@@ -244,9 +725,9 @@ class ClaimThread(commands.Cog):
     @commands.command()
     async def overrideaddclaim(self, ctx, *, member: discord.Member):
         """Allow mods to bypass claim thread check in add"""
-        thread = await self.db.find_one({'thread_id': str(ctx.thread.channel.id), 'guild': str(self.bot.modmail_guild.id)})
+        thread = await self.find_claim(ctx.thread.channel.id)
         if thread:
-            await self.db.find_one_and_update({'thread_id': str(ctx.thread.channel.id), 'guild': str(self.bot.modmail_guild.id)}, {'$addToSet': {'claimers': str(member.id)}})
+            await self.add_claimer(ctx.thread.channel.id, member.id, event='forced_claim', by=ctx.author.id)
             await ctx.send('Added to claimers')
 
 
@@ -265,13 +746,203 @@ class ClaimThread(commands.Cog):
 
         await ctx.send(f'Set limit to {limit}')
 
+    @checks.has_permissions(PermissionLevel.MODERATOR)
+    @commands.guild_only()
+    @claim_.command(name='reassign')
+    async def claim_reassign(self, ctx, source: discord.User, target: discord.Member = None):
+        """
+        Move all claims of a supporter to another supporter
+        Without a target, the claims are spread over the least busy online supporters of `claim auto roles`
+        """
+        claims = await self.db.find(
+            {'guild': self.id_query(self.bot.modmail_guild.id), 'claimers': self.id_query(source.id)},
+            {'thread_id': 1, 'claimers': 1, 'subscribers': 1, 'recipient': 1},
+        ).to_list(None)
+        if not claims:
+            return await ctx.send(f'{source.name} has no claimed threads')
+
+        if self.claim_counts is None:
+            await self.rebuild_claim_counts()
+        config = await self.db.find_one({'_id': 'config'}) or {}
+
+        requests = []
+        events = []
+        now = discord.utils.utcnow()
+        moved = Counter()
+        skipped = 0
+        for x in claims:
+            member = target or await self.pick_supporter(config, exclude=source.id)
+            if member is None:
+                skipped += 1
+                continue
+
+            before = [int(c) for c in x['claimers']]
+            claimers = list(dict.fromkeys(member.id if c == source.id else c for c in before))
+            update = {'claimers': claimers}
+
+            subscribers = x.get('subscribers', [])
+            if source.id in subscribers:
+                update['subscribers'] = list(dict.fromkeys(member.id if c == source.id else c for c in subscribers))
+                if x.get('recipient') is not None:
+                    mentions = self.bot.config["subscriptions"].setdefault(str(x['recipient']), [])
+                    if source.mention in mentions:
+                        mentions.remove(source.mention)
+                    if member.mention not in mentions:
+                        mentions.append(member.mention)
+
+            requests.append(UpdateOne({'_id': x['_id']}, {'$set': update}))
+            for supporter in (source.id, member.id):
+                events.append({'thread_id': int(x['thread_id']), 'supporter': supporter, 'event': 'reassigned', 'by': ctx.author.id, 'at': now, 'claimers': claimers})
+            # counters move before the write so the next pick sees the new load
+            self.update_claim_counts(before, claimers)
+            moved[member] += 1
+
+        if requests:
+            try:
+                await self.db.bulk_write(requests, ordered=False)
+            except Exception:
+                await self.rebuild_claim_counts()
+                raise
+            await self.journal.insert_many(events, ordered=False)
+
+        embed = discord.Embed(title='Claims reassigned', color=self.bot.main_color)
+        embed.description = '\n'.join(f'{m.mention}: {n}' for m, n in moved.most_common()) or 'Nothing to do'
+        embed.set_footer(text=f'{sum(moved.values())} threads moved from {source.name}' + (f', {skipped} without an available supporter' if skipped else ''))
+        await ctx.send(embed=embed)
+
+    @checks.has_permissions(PermissionLevel.SUPPORTER)
+    @claim_.command(name='history')
+    async def claim_history(self, ctx, channel: discord.TextChannel = None):
+        """Show the latest claim events of a thread"""
+        channel = channel or ctx.channel
+        events = await self.journal.find({'thread_id': channel.id}).sort('at', -1).limit(20).to_list(None)
+
+        embed = discord.Embed(title=f'Claim history of #{channel.name}', color=self.bot.main_color)
+        embed.description = '\n'.join(
+            f"<t:{int(x['at'].replace(tzinfo=datetime.timezone.utc).timestamp())}:f> `{x['event']}` <@{x['supporter']}>"
+            + (f" by <@{x['by']}>" if x.get('by') and x['by'] != x['supporter'] else '')
+            for x in reversed(events)
+        ) or 'No claim events recorded'
+        await ctx.send(embed=embed)
+
+    @checks.has_permissions(PermissionLevel.MODERATOR)
+    @claim_.group(name='stats', invoke_without_command=True)
+    async def claim_stats(self, ctx, days: int = 7, member: discord.Member = None):
+        """
+        Time to first claim and claim events in the last days
+        Optionally only for one supporter
+        """
+        if ctx.invoked_subcommand:
+            return
+
+        query = {'at': {'$gte': discord.utils.utcnow() - datetime.timedelta(days=days)}}
+        if member:
+            query['supporter'] = member.id
+
+        counts = {}
+        async for x in self.journal.aggregate([{'$match': query}, {'$group': {'_id': '$event', 'count': {'$sum': 1}}}]):
+            counts[x['_id']] = x['count']
+
+        # fixed log buckets keep memory constant however many claims there are
+        buckets = [0] * (WAIT_BUCKETS + 1)
+        total = 0
+        cursor = self.journal.find({**query, 'wait': {'$exists': True}}, {'wait': 1, '_id': 0})
+        async for x in cursor:
+            wait = max(x['wait'], 1)
+            buckets[min(math.ceil(math.log(wait, WAIT_BUCKET_BASE)), WAIT_BUCKETS)] += 1
+            total += 1
+
+        embed = discord.Embed(title=f'Claim stats - last {days} days', color=self.bot.main_color)
+        if member:
+            embed.title += f' - {member.name}'
+        embed.add_field(
+            name='Events',
+            value='\n'.join(f'{k}: {v}' for k, v in sorted(counts.items())) or 'None',
+            inline=False,
+        )
+        if total:
+            embed.add_field(
+                name=f'Wait before first claim ({total} threads)',
+                value='\n'.join(
+                    f'p{q}: {format_duration(wait_percentile(buckets, total, q))}' for q in (50, 75, 90, 99)
+                ),
+                inline=False,
+            )
+        await ctx.send(embed=embed)
+
+    @checks.has_permissions(PermissionLevel.MODERATOR)
+    @claim_stats.command(name='retention')
+    async def claim_stats_retention(self, ctx, days: int):
+        """Days to keep claim events for"""
+        await self.db.database.command(
+            'collMod', self.journal.name,
+            index={'keyPattern': {'at': 1}, 'expireAfterSeconds': days * 86400},
+        )
+        await self.db.find_one_and_update({'_id': 'config'}, {'$set': {'journal_days': days}}, upsert=True)
+        await ctx.send(f'Claim events are now kept for {days} days')
+
+    @checks.has_permissions(PermissionLevel.MODERATOR)
+    @commands.guild_only()
+    @claim_.group(name='auto', invoke_without_command=True)
+    async def claim_auto_(self, ctx, enabled: bool = None):
+        """
+        Automatically assign new threads to the least busy online supporter
+        Supporters are picked from the roles set with `claim auto roles`
+        """
+        if not ctx.invoked_subcommand:
+            config = await self.db.find_one({'_id': 'config'}) or {}
+            if enabled is None:
+                enabled = not config.get('auto_assign', False)
+
+            await self.db.find_one_and_update({'_id': 'config'}, {'$set': {'auto_assign': enabled}}, upsert=True)
+            await ctx.send(f"Auto assign is now {'enabled' if enabled else 'disabled'}")
+
+    @checks.has_permissions(PermissionLevel.MODERATOR)
+    @commands.guild_only()
+    @claim_auto_.command(name='roles')
+    async def claim_auto_roles(self, ctx, *roles: discord.Role):
+        """Set the roles whose members can be auto assigned threads"""
+        await self.db.find_one_and_update({'_id': 'config'}, {'$set': {'auto_roles': [r.id for r in roles]}}, upsert=True)
+        self.assign_pool = None
+
+        added = ", ".join(f"`{r.name}`" for r in roles) or "`None`"
+        await ctx.send(f'**Auto assign roles**:\n{added}')
+
+    @checks.has_permissions(PermissionLevel.MODERATOR)
+    @commands.guild_only()
+    @claim_.command(name='expiry')
+    async def claim_expiry(self, ctx, hours: int, warn_hours: int = 0):
+        """
+        Release claims when no claimer replied for some hours
+        `warn_hours` before expiry the claimers are pinged in the thread
+        0 = Never expire
+        """
+        if warn_hours >= hours:
+            warn_hours = 0
+
+        await self.db.find_one_and_update({'_id': 'config'}, {'$set': {'expiry_hours': hours, 'expiry_warn_hours': warn_hours}}, upsert=True)
+        self.expiry_hours = hours
+        self.expiry_warn_hours = warn_hours
+
+        if hours:
+            deadline = time.time() + hours * 3600
+            await self.db.update_many(
+                {'claimers.0': {'$exists': True}, 'expires_at': {'$exists': False}},
+                {'$set': {'expires_at': deadline, 'expiry_warned': False}},
+            )
+        else:
+            await self.db.update_many({'expires_at': {'$exists': True}}, {'$unset': {'expires_at': '', 'expiry_warned': ''}})
+        await self.load_expiry()
+
+        await ctx.send(f'Set claim expiry to {hours} hours' if hours else 'Claims no longer expire')
+
     @checks.has_permissions(PermissionLevel.MODERATOR)
     @commands.guild_only()
     @claim_.group(name='bypass', invoke_without_command=True)
     async def claim_bypass_(self, ctx):
         """Manage bypass roles to claim check"""
         if not ctx.invoked_subcommand:
-            if (roles_guild:= await self.db.find_one({'_id': 'config'})) and len(roles_guild['bypass_roles']) != 0:
+            if (roles_guild:= await self.db.find_one({'_id': 'config'})) and roles_guild.get('bypass_roles'):
                 added = ", ".join(f"`{ctx.guild.get_role(r).name}`" for r in roles_guild['bypass_roles'])
                 await ctx.send(f'By-pass roles: {added}')
             else:
@@ -312,7 +983,7 @@ class ClaimThread(commands.Cog):
     async def claim_bypass_remove(self, ctx, role: discord.Role):
         """Remove a bypass role from claim check"""
         roles_guild = await self.db.find_one({'_id': 'config'})
-        if roles_guild and role.id in roles_guild['bypass_roles']:
+        if roles_guild and role.id in roles_guild.get('bypass_roles', []):
             await self.db.find_one_and_update({'_id': 'config'}, {'$pull': {'bypass_roles': role.id}})
             await ctx.send(f'**Removed from by-pass roles**:\n`{role.name}`')
         else:
@@ -325,8 +996,30 @@ class ClaimThread(commands.Cog):
         """Allow mods to bypass claim thread check in reply"""
         await ctx.invoke(self.bot.get_command('reply'), msg=msg)
 
+def wait_percentile(buckets, total, q):
+    """Upper bound of the log bucket holding the q-th percentile"""
+    rank = math.ceil(total * q / 100)
+    seen = 0
+    for i, n in enumerate(buckets):
+        seen += n
+        if seen >= rank:
+            return WAIT_BUCKET_BASE ** i
+    return WAIT_BUCKET_BASE ** (len(buckets) - 1)
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return f'{seconds}s'
+    if seconds < 3600:
+        return f'{seconds // 60}m {seconds % 60}s'
+    if seconds < 86400:
+        return f'{seconds // 3600}h {seconds % 3600 // 60}m'
+    return f'{seconds // 86400}d {seconds % 86400 // 3600}h'
+
+
 async def check_reply(ctx):
-    thread = await ctx.bot.get_cog('ClaimThread').db.find_one({'thread_id': str(ctx.thread.channel.id), 'guild': str(ctx.bot.modmail_guild.id)})
+    thread = await ctx.bot.get_cog('ClaimThread').find_claim(ctx.thread.channel.id)
     if thread and len(thread['claimers']) != 0:
         in_role = False
         if config:= await ctx.bot.get_cog('ClaimThread').db.find_one({'_id': 'config'}):
@@ -335,7 +1028,7 @@ async def check_reply(ctx):
                 for role in roles:
                     if role in ctx.author.roles:
                         in_role = True
-        return ctx.author.bot or in_role or str(ctx.author.id) in thread['claimers']
+        return ctx.author.bot or in_role or ctx.author.id in thread['claimers']
     return True
 
 
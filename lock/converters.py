@@ -1,4 +1,6 @@
-from typing import Optional, Union
+import re
+from datetime import timedelta
+from typing import Dict, Optional, Union
 
 import discord
 from rapidfuzz import process
@@ -6,6 +8,22 @@ from discord.ext import commands
 from unidecode import unidecode
 
 
+# guild id -> {role id: transliterated name}, kept fresh by the Lock cog's role listeners.
+# ids rather than Role objects, so a guild resync never leaves stale roles behind
+_role_names: Dict[int, Dict[int, str]] = {}
+
+
+def role_names(guild: discord.Guild) -> Dict[int, str]:
+    names = _role_names.get(guild.id)
+    if names is None:
+        names = _role_names[guild.id] = {r.id: unidecode(r.name) for r in guild.roles}
+    return names
+
+
+def invalidate_role_names(guild: discord.Guild) -> None:
+    _role_names.pop(guild.id, None)
+
+
 class ChannelToggle(commands.Converter):
     async def convert(self, ctx: commands.Context, arg: str) -> Union[bool, None]:
         arg = arg.lower()
@@ -20,6 +38,18 @@ class ChannelToggle(commands.Converter):
         return ret
 
 
+class Duration(commands.Converter):
+    UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+    PATTERN = re.compile(r"(\d+)([smhdw])")
+
+    async def convert(self, ctx: commands.Context, arg: str) -> timedelta:
+        arg = arg.lower()
+        parts = self.PATTERN.findall(arg)
+        if not parts or "".join(n + u for n, u in parts) != arg:
+            raise commands.BadArgument(f"`{arg}` is not a valid duration, try something like `10m` or `1h30m`.")
+        return timedelta(seconds=sum(int(n) * self.UNITS[u] for n, u in parts))
+
+
 class LockableChannel(commands.TextChannelConverter):
     async def convert(self, ctx: commands.Context, arg: str) -> Optional[discord.TextChannel]:
         channel = await super().convert(ctx, arg)
@@ -58,21 +88,12 @@ class FuzzyRole(commands.RoleConverter):
             pass
         else:
             return basic_role
-        guild = ctx.guild
-        result = [
-            (r[2], r[1])
-            for r in process.extract(
-                argument,
-                {r: unidecode(r.name) for r in guild.roles},
-                limit=None,
-                score_cutoff=75,
-            )
-        ]
-        if not result:
+        result = process.extractOne(argument, role_names(ctx.guild), score_cutoff=75)
+        role = result and ctx.guild.get_role(result[2])
+        if role is None:
             raise commands.BadArgument(f'Role "{argument}" not found.' if self.response else None)
 
-        sorted_result = sorted(result, key=lambda r: r[1], reverse=True)
-        return sorted_result[0][0]
+        return role
 
 
 class LockableRole(FuzzyRole):
@@ -1,18 +1,41 @@
 #taken from: https://github.com/phenom4n4n/phen-cogs/tree/master/lock
 
+import asyncio
+import heapq
+from bisect import bisect_left
+import time
 from copy import copy
+from datetime import timedelta
 from typing import List, Literal, Optional, Union, Sequence
 
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
+from pymongo import ReturnDocument, UpdateOne
 
 from core import checks
-from core.models import PermissionLevel
+from core.models import PermissionLevel, getLogger
 
-from .converters import ChannelToggle, LockableChannel, LockableRole
+from .converters import ChannelToggle, Duration, LockableChannel, LockableRole, invalidate_role_names
 
 from babel.lists import format_list as babel_list
 
+logger = getLogger(__name__)
+
+LOCKDOWN_CONCURRENCY = 4
+PROGRESS_INTERVAL = 3
+
+SLOWMODE_STEPS = (0, 2, 5, 10, 15, 30, 60, 120)
+SLOWMODE_WINDOW = 60
+SLOWMODE_EDIT_INTERVAL = 30
+SLOWMODE_LOW = 0.5
+
+ADMINISTRATOR = discord.Permissions(administrator=True).value
+AUDIT_FLAGS = (
+    discord.Permissions(view_channel=True).value,
+    discord.Permissions(send_messages=True).value,
+    discord.Permissions(connect=True).value,
+)
+
 def humanize_list(
     items: Sequence[str], *, style: str = "standard"
 ) -> str:
@@ -65,12 +88,221 @@ def inline(text: str) -> str:
     else:
         return f"`{text}`"
 
+def slowmode_step(delay: int, base: int) -> int:
+    """Get the lowest slowmode step that keeps a channel at its current delay."""
+    if delay <= base:
+        return 0
+    return min(bisect_left(SLOWMODE_STEPS, delay), len(SLOWMODE_STEPS) - 1)
+
+class RateWindow:
+    """Sliding count of events over the last ``size`` seconds, in one-second buckets."""
+
+    __slots__ = ("buckets", "last", "total")
+
+    def __init__(self, size: int = SLOWMODE_WINDOW):
+        self.buckets = [0] * size
+        self.last = 0
+        self.total = 0
+
+    def advance(self, now: float) -> int:
+        second = int(now)
+        gap = second - self.last
+        if gap >= len(self.buckets):
+            self.buckets = [0] * len(self.buckets)
+            self.total = 0
+        else:
+            for s in range(self.last + 1, second + 1):
+                i = s % len(self.buckets)
+                self.total -= self.buckets[i]
+                self.buckets[i] = 0
+        self.last = max(self.last, second)
+        return self.total
+
+    def add(self, now: float) -> int:
+        self.advance(now)
+        self.buckets[self.last % len(self.buckets)] += 1
+        self.total += 1
+        return self.total
+
 class Lock(commands.Cog):
     """
     Advanced channel and server locking.
     """
     def __init__(self, bot) -> None:
         self.bot = bot
+        self.db = bot.api.get_plugin_partition(self)
+        self.timers = self.db.database[f"{self.db.name}.timers"]
+        self.lockdowns = {}
+        self.unlock_deadlines = {}
+        self.unlock_heap = []
+        self.unlock_wakeup = asyncio.Event()
+        self.unlock_task = None
+        self.slowmode = {}
+
+    async def cog_load(self):
+        self.bot.loop.create_task(self.resume_lockdowns())
+        if self.unlock_task is None:
+            self.unlock_task = self.bot.loop.create_task(self.unlock_loop())
+
+        async for x in self.db.find({"type": "slowmode"}):
+            step = x.get("step")
+            if step is None:
+                channel = self.bot.get_channel(x["channel_id"])
+                step = slowmode_step(channel.slowmode_delay, x["base"]) if channel else 0
+            self.enroll_slowmode(x["channel_id"], x["rate"], x["base"], step)
+        if not self.slowmode_sweep.is_running():
+            self.slowmode_sweep.start()
+
+    def cog_unload(self):
+        # progress is checkpointed, interrupted lockdowns pick up on the next load
+        for task in self.lockdowns.values():
+            task.cancel()
+        if self.unlock_task:
+            self.unlock_task.cancel()
+        self.slowmode_sweep.cancel()
+
+    def enroll_slowmode(self, channel_id: int, rate: int, base: int, step: int = 0):
+        self.slowmode[channel_id] = {
+            "rate": rate,
+            "base": base,
+            "step": step,
+            "edited_at": 0,
+            "window": RateWindow(),
+        }
+
+    @commands.Cog.listener()
+    async def on_message(self, message: discord.Message):
+        state = self.slowmode.get(message.channel.id)
+        if state is None or message.author.bot:
+            return
+
+        now = time.time()
+        state["window"].add(now)
+        if now - state["edited_at"] >= SLOWMODE_EDIT_INTERVAL:
+            await self.adjust_slowmode(message.channel, state, now)
+
+    @tasks.loop(seconds=SLOWMODE_EDIT_INTERVAL)
+    async def slowmode_sweep(self):
+        # quiet channels send no messages, so stepping back down needs a timer
+        now = time.time()
+        for channel_id, state in list(self.slowmode.items()):
+            if state["step"] and now - state["edited_at"] >= SLOWMODE_EDIT_INTERVAL:
+                channel = self.bot.get_channel(channel_id)
+                if channel is not None:
+                    state["window"].advance(now)
+                    await self.adjust_slowmode(channel, state, now)
+
+    async def adjust_slowmode(self, channel: discord.TextChannel, state: dict, now: float):
+        """Move one slowmode step up or down, leaving a dead band between the two thresholds"""
+        rate = state["window"].total * 60 / SLOWMODE_WINDOW
+        step = state["step"]
+        if rate > state["rate"] and step < len(SLOWMODE_STEPS) - 1:
+            step += 1
+        elif rate < state["rate"] * SLOWMODE_LOW and step > 0:
+            step -= 1
+        else:
+            return
+
+        state["step"] = step
+        state["edited_at"] = now
+        delay = max(SLOWMODE_STEPS[step], state["base"])
+        if delay != channel.slowmode_delay:
+            try:
+                await channel.edit(slowmode_delay=delay, reason="Automatic slowmode")
+            except discord.HTTPException as e:
+                logger.warning(f"Failed to set automatic slowmode in {channel.id}: {e}")
+        # a restart resumes from this step, so a raised slowmode still steps down
+        await self.db.update_one({"_id": f"slowmode:{channel.id}"}, {"$set": {"step": step}})
+
+    async def schedule_unlock(self, channel: discord.abc.GuildChannel, duration: timedelta, target_ids) -> float:
+        """Set the channel's unlock deadline, replacing any earlier one.
+
+        Only the targets locked with a duration are restored when it runs out,
+        so targets locked separately stay locked.
+        """
+        deadline = time.time() + duration.total_seconds()
+        self.unlock_deadlines[channel.id] = deadline
+        heapq.heappush(self.unlock_heap, (deadline, channel.id))
+        self.unlock_wakeup.set()
+        await self.timers.update_one(
+            {"_id": channel.id},
+            {
+                "$set": {"guild_id": channel.guild.id, "unlock_at": deadline},
+                "$addToSet": {"targets": {"$each": [str(t) for t in target_ids]}},
+            },
+            upsert=True,
+        )
+        return deadline
+
+    async def cancel_unlocks(self, channel_ids) -> None:
+        for channel_id in channel_ids:
+            self.unlock_deadlines.pop(channel_id, None)
+        await self.timers.delete_many({"_id": {"$in": list(channel_ids)}})
+
+    async def unlock_loop(self):
+        """Single scheduler that sleeps until the next timed lock runs out"""
+        await self.bot.wait_until_ready()
+        self.unlock_deadlines.clear()
+        self.unlock_heap = []
+        async for x in self.timers.find():
+            self.unlock_deadlines[x["_id"]] = x["unlock_at"]
+            self.unlock_heap.append((x["unlock_at"], x["_id"]))
+        heapq.heapify(self.unlock_heap)
+
+        while True:
+            self.unlock_wakeup.clear()
+            delay = self.unlock_heap[0][0] - time.time() if self.unlock_heap else None
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self.unlock_wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            deadline, channel_id = heapq.heappop(self.unlock_heap)
+            if self.unlock_deadlines.get(channel_id) != deadline:
+                continue
+
+            try:
+                await self.timed_unlock(channel_id)
+            except Exception as e:
+                logger.error(f"Failed to unlock {channel_id} after a timed lock: {e}")
+
+    async def timed_unlock(self, channel_id: int):
+        timer = await self.timers.find_one({"_id": channel_id})
+        await self.cancel_unlocks([channel_id])
+        channel = self.bot.get_channel(channel_id)
+        snapshot = await self.db.find_one({"_id": f"snapshot:{channel_id}"})
+        if channel is None or snapshot is None or timer is None:
+            return
+
+        targets = {t for t in timer.get("targets", snapshot["overwrites"]) if t in snapshot["overwrites"]}
+        # the bot keeps its own overwrite while anything else in the channel is still locked
+        if set(snapshot["overwrites"]) - targets - {str(channel.guild.me.id)}:
+            targets.discard(str(channel.guild.me.id))
+
+        overwrites = {t: snapshot["overwrites"][t] for t in targets}
+        await self.restore_channel(channel, {"overwrites": overwrites}, "Timed lock expired")
+        await self.forget_snapshot(channel, targets)
+
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role: discord.Role):
+        invalidate_role_names(role.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role):
+        if before.name != after.name:
+            invalidate_role_names(after.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role: discord.Role):
+        invalidate_role_names(role.guild)
+
+    async def resume_lockdowns(self):
+        await self.bot.wait_until_ready()
+        async for doc in self.db.find({"type": "lockdown"}):
+            if doc["guild_id"] not in self.lockdowns:
+                self.lockdowns[doc["guild_id"]] = self.bot.loop.create_task(self.run_lockdown(doc))
 
     @commands.bot_has_permissions(manage_roles=True)
     @commands.group(invoke_without_command=True)
@@ -79,16 +311,20 @@ class Lock(commands.Cog):
         self,
         ctx: commands.Context,
         channel: Optional[Union[LockableChannel, discord.VoiceChannel]] = None,
+        duration: Optional[Duration] = None,
         roles_or_members: commands.Greedy[Union[LockableRole, discord.Member]] = None,
     ):
         """
         Lock a channel.
 
         Provide a role or member if you would like to lock it for them.
+        Provide a duration if you would like it to unlock by itself.
+        Locking the channel again replaces the timer, or cancels it if no duration is given.
         You can only lock a maximum of 10 things at once.
 
         **Examples:**
         `{prefix}lock #general`
+        `{prefix}lock #general 10m`
         `{prefix}lock 123456789000000 @members`
         """
         try:
@@ -102,45 +338,22 @@ class Lock(commands.Cog):
             roles_or_members = [ctx.guild.default_role]
         else:
             roles_or_members = roles_or_members[:10]
-        succeeded = []
-        cancelled = []
-        failed = []
         reason = get_audit_reason(ctx.author)
-
-        if isinstance(channel, discord.TextChannel):
-            for role in roles_or_members:
-                current_perms = channel.overwrites_for(role)
-                my_perms = channel.overwrites_for(ctx.me)
-                if my_perms.send_messages != True:
-                    my_perms.update(send_messages=True)
-                    await channel.set_permissions(ctx.me, overwrite=my_perms)
-                if current_perms.send_messages == False:
-                    cancelled.append(inline(role.name))
-                else:
-                    current_perms.update(send_messages=False)
-                    try:
-                        await channel.set_permissions(role, overwrite=current_perms, reason=reason)
-                        succeeded.append(inline(role.name))
-                    except:
-                        failed.append(inline(role.name))
-        elif isinstance(channel, discord.VoiceChannel):
-            for role in roles_or_members:
-                current_perms = channel.overwrites_for(role)
-                if current_perms.connect == False:
-                    cancelled.append(inline(role.name))
-                else:
-                    current_perms.update(connect=False)
-                    try:
-                        await channel.set_permissions(role, overwrite=current_perms, reason=reason)
-                        succeeded.append(inline(role.name))
-                    except:
-                        failed.append(inline(role.name))
+        perm = "send_messages" if isinstance(channel, discord.TextChannel) else "connect"
+        succeeded, cancelled, failed, held = await self.lock_channel(channel, roles_or_members, perm, reason)
 
         msg = ""
         if succeeded:
             msg += f"{channel.mention} has been locked for {humanize_list(succeeded)}.\n"
         if cancelled:
             msg += f"{channel.mention} was already locked for {humanize_list(cancelled)}.\n"
+        if succeeded or cancelled:
+            # re-locking targets that are already locked still moves or clears the timer
+            if duration:
+                deadline = await self.schedule_unlock(channel, duration, held)
+                msg += f"It will be unlocked <t:{int(deadline)}:R>.\n"
+            else:
+                await self.cancel_unlocks([channel.id])
         if failed:
             msg += f"I failed to lock {channel.mention} for {humanize_list(failed)}.\n"
         if msg:
@@ -170,47 +383,41 @@ class Lock(commands.Cog):
         except discord.Forbidden:
             return
 
+        if channel is None:
+            return await ctx.send_help(ctx.command)
+
         roles_or_members = roles_or_members[:10]
         succeeded = []
         cancelled = []
         failed = []
         reason = get_audit_reason(ctx.author)
 
-        if isinstance(channel, discord.TextChannel):
-            for role in roles_or_members:
-                current_perms = channel.overwrites_for(role)
-                my_perms = channel.overwrites_for(ctx.me)
-                if my_perms.send_messages != True:
-                    my_perms.update(send_messages=True)
-                    await channel.set_permissions(ctx.me, overwrite=my_perms)
-                if current_perms.send_messages == True:
-                    cancelled.append(inline(role.name))
-                else:
-                    current_perms.update(view_channel= True, send_messages=True)
-                    try:
-                        await channel.set_permissions(role, overwrite=current_perms, reason=reason)
-                        succeeded.append(inline(role.name))
-                    except:
-                        failed.append(inline(role.name))
-        elif isinstance(channel, discord.VoiceChannel):
-            for role in roles_or_members:
-                current_perms = channel.overwrites_for(role)
-                if current_perms.connect == True:
-                    cancelled.append(inline(role.name))
-                else:
-                    current_perms.update(view_channel= True, connect=True)
-                    try:
-                        await channel.set_permissions(role, overwrite=current_perms, reason=reason)
-                        succeeded.append(inline(role.name))
-                    except:
-                        failed.append(inline(role.name))
+        overwrites = channel.overwrites
+        perm = "send_messages" if isinstance(channel, discord.TextChannel) else "connect"
+        if perm == "send_messages" and roles_or_members:
+            my_perms = channel.overwrites_for(ctx.me)
+            if my_perms.send_messages != True:
+                my_perms.update(send_messages=True)
+                overwrites[ctx.me] = my_perms
+
+        for role in roles_or_members:
+            current_perms = channel.overwrites_for(role)
+            if getattr(current_perms, perm) == True:
+                cancelled.append(inline(role.name))
+            else:
+                current_perms.update(view_channel=True, **{perm: True})
+                overwrites[role] = current_perms
+                succeeded.append(inline(role.name))
 
         if len(succeeded) != 0 or len(cancelled) != 0:
             for r in channel.changed_roles:
                 if r not in roles_or_members:
-                    await channel.set_permissions(
-                        r, view_channel=False, send_messages=False
-                    )
+                    overwrites[r] = discord.PermissionOverwrite(view_channel=False, send_messages=False)
+
+        try:
+            await self.apply_overwrites(channel, overwrites, reason)
+        except discord.HTTPException:
+            failed, succeeded = succeeded, []
 
         msg = ""
         if succeeded:
@@ -229,16 +436,20 @@ class Lock(commands.Cog):
         self,
         ctx: commands.Context,
         channel: Optional[Union[LockableChannel, discord.VoiceChannel]] = None,
+        duration: Optional[Duration] = None,
         roles_or_members: commands.Greedy[Union[LockableRole, discord.Member]] = None,
     ):
         """
         Prevent users from viewing a channel.
 
         Provide a role or member if you would like to lock it for them.
+        Provide a duration if you would like it to unlock by itself.
+        Locking the channel again replaces the timer, or cancels it if no duration is given.
         You can only lock a maximum of 10 things at once.
 
         **Example:**
         `{prefix}viewlock #secret-channel`
+        `{prefix}viewlock #secret-channel 1h`
         `{prefix}viewlock 123456789000000 @nubs`
         """
         try:
@@ -252,28 +463,21 @@ class Lock(commands.Cog):
             roles_or_members = [ctx.guild.default_role]
         else:
             roles_or_members = roles_or_members[:10]
-        succeeded = []
-        cancelled = []
-        failed = []
         reason = get_audit_reason(ctx.author)
-
-        for role in roles_or_members:
-            current_perms = channel.overwrites_for(role)
-            if current_perms.read_messages == False:
-                cancelled.append(inline(role.name))
-            else:
-                current_perms.update(read_messages=False)
-                try:
-                    await channel.set_permissions(role, overwrite=current_perms, reason=reason)
-                    succeeded.append(inline(role.name))
-                except:
-                    failed.append(inline(role.name))
+        succeeded, cancelled, failed, held = await self.lock_channel(channel, roles_or_members, "read_messages", reason)
 
         msg = ""
         if succeeded:
             msg += f"{channel.mention} has been viewlocked for {humanize_list(succeeded)}.\n"
         if cancelled:
             msg += f"{channel.mention} was already viewlocked for {humanize_list(cancelled)}.\n"
+        if succeeded or cancelled:
+            # re-locking targets that are already locked still moves or clears the timer
+            if duration:
+                deadline = await self.schedule_unlock(channel, duration, held)
+                msg += f"It will be unlocked <t:{int(deadline)}:R>.\n"
+            else:
+                await self.cancel_unlocks([channel.id])
         if failed:
             msg += f"I failed to viewlock {channel.mention} for {humanize_list(failed)}.\n"
         if msg:
@@ -318,6 +522,417 @@ class Lock(commands.Cog):
                 f"I failed to lock the server for {humanize_list(failed)}, probably because I was lower than the roles in heirarchy."
             )
 
+    @lock.command("category")
+    @checks.has_permissions(PermissionLevel.ADMIN)
+    async def lock_category(
+        self, ctx: commands.Context, category: discord.CategoryChannel, *roles: LockableRole
+    ):
+        """
+        Lock every channel in a category.
+
+        Provide a role if you would like to lock it for that role.
+
+        **Example:**
+        `{prefix}lock category Community @members`
+        """
+        await self.start_lockdown(ctx, category.channels, roles)
+
+    @lock.command("all")
+    @checks.has_permissions(PermissionLevel.ADMIN)
+    async def lock_all(self, ctx: commands.Context, *roles: LockableRole):
+        """
+        Lock every text and voice channel in the server.
+
+        Unlike `{prefix}lock server`, this sets channel overwrites, so channels that
+        explicitly allow a role are locked too.
+
+        **Example:**
+        `{prefix}lock all @members`
+        """
+        await self.start_lockdown(ctx, ctx.guild.channels, roles)
+
+    async def start_lockdown(self, ctx: commands.Context, channels, roles):
+        if ctx.guild.id in self.lockdowns:
+            return await ctx.send("A lockdown is already running in this server.")
+
+        # hold the slot before the first await, so two lockdowns can't start at once
+        self.lockdowns[ctx.guild.id] = asyncio.current_task()
+        task = None
+        try:
+            roles = list(roles) or [ctx.guild.default_role]
+            plan = []
+            skipped = []
+            scope = []
+            for channel in channels:
+                if not isinstance(channel, (discord.TextChannel, discord.VoiceChannel)):
+                    continue
+                scope.append(channel.id)
+                if not channel.permissions_for(ctx.me).manage_roles:
+                    skipped.append(channel.mention)
+                elif self.lock_overwrites(channel, roles) != channel.overwrites:
+                    plan.append(channel.id)
+
+            # timed locks would lift the lockdown early, already locked channels included
+            await self.cancel_unlocks(scope)
+            if skipped:
+                await ctx.send(f"I cannot edit permissions in {humanize_list(skipped)}, skipping them.")
+            if not plan:
+                return await ctx.send(
+                    f"Those channels are already locked for {humanize_list([inline(r.name) for r in roles])}."
+                )
+
+            doc = {
+                "_id": f"lockdown:{ctx.guild.id}",
+                "type": "lockdown",
+                "guild_id": ctx.guild.id,
+                "channel_id": ctx.channel.id,
+                "roles": [r.id for r in roles],
+                "reason": get_audit_reason(ctx.author, "Lockdown", shorten=True),
+                "total": len(plan),
+                "pending": plan,
+                "done": 0,
+                "failed": [],
+            }
+            await self.db.bulk_write(
+                [self.snapshot_update(c, self.lock_overwrites(c, roles)) for c in map(ctx.guild.get_channel, plan)]
+            )
+            message = await ctx.send(self.lockdown_progress(doc, roles))
+            doc["message_id"] = message.id
+            await self.db.replace_one({"_id": doc["_id"]}, doc, upsert=True)
+            task = self.bot.loop.create_task(self.run_lockdown(doc))
+        finally:
+            if task is None:
+                self.lockdowns.pop(ctx.guild.id, None)
+            else:
+                self.lockdowns[ctx.guild.id] = task
+
+    async def run_lockdown(self, doc: dict):
+        """Apply a planned lockdown with a few concurrent workers, checkpointing as channels finish"""
+        try:
+            guild = self.bot.get_guild(doc["guild_id"])
+            if guild is None:
+                return await self.db.delete_one({"_id": doc["_id"]})
+
+            roles = [r for r in map(guild.get_role, doc["roles"]) if r is not None]
+            message = self.bot.get_partial_messageable(doc["channel_id"]).get_partial_message(doc["message_id"])
+            queue = asyncio.Queue()
+            for channel_id in doc["pending"]:
+                queue.put_nowait(channel_id)
+            finished = []
+
+            async def worker():
+                while not queue.empty():
+                    channel_id = queue.get_nowait()
+                    channel = guild.get_channel(channel_id)
+                    try:
+                        if channel is not None:
+                            await self.apply_overwrites(
+                                channel, self.lock_overwrites(channel, roles), doc["reason"]
+                            )
+                    except discord.HTTPException:
+                        doc["failed"].append(channel_id)
+                    finished.append(channel_id)
+
+            workers = [asyncio.create_task(worker()) for _ in range(LOCKDOWN_CONCURRENCY)]
+            try:
+                pending = set(workers)
+                while pending:
+                    _, pending = await asyncio.wait(pending, timeout=PROGRESS_INTERVAL)
+                    batch, finished[:] = finished[:], []
+                    if not batch:
+                        continue
+
+                    doc["done"] += len(batch)
+                    await self.db.update_one(
+                        {"_id": doc["_id"]},
+                        {
+                            "$pull": {"pending": {"$in": batch}},
+                            "$inc": {"done": len(batch)},
+                            "$set": {"failed": doc["failed"]},
+                        },
+                    )
+                    try:
+                        await message.edit(content=self.lockdown_progress(doc, roles))
+                    except discord.HTTPException:
+                        pass
+            finally:
+                # the next load resumes from the checkpoint, so no worker may keep editing channels
+                for w in workers:
+                    w.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+
+            await self.db.delete_one({"_id": doc["_id"]})
+        finally:
+            self.lockdowns.pop(doc["guild_id"], None)
+
+    @staticmethod
+    def lockdown_progress(doc: dict, roles) -> str:
+        names = humanize_list([inline(r.name) for r in roles]) if roles else "nobody"
+        failed = "".join(f"\nFailed: <#{c}>" for c in doc["failed"][:20])
+        if doc["done"] >= doc["total"]:
+            return f"Locked {doc['total'] - len(doc['failed'])}/{doc['total']} channels for {names}.{failed}"
+        return f"Locking channels for {names}... {doc['done']}/{doc['total']} done.{failed}"
+
+    async def lock_channel(self, channel: discord.abc.GuildChannel, roles_or_members, perm: str, reason: str):
+        """Deny ``perm`` for each target in one edit, snapshotting the overwrites it replaces first.
+
+        Also returns the ids of the targets the lock holds, the ones it changed
+        and the ones that were already locked, for an unlock timer.
+        """
+        succeeded = []
+        cancelled = []
+        failed = []
+        held = []
+        for role in roles_or_members:
+            if getattr(channel.overwrites_for(role), perm) == False:
+                cancelled.append(inline(role.name))
+                held.append(role.id)
+            else:
+                succeeded.append(inline(role.name))
+
+        if succeeded:
+            overwrites = self.lock_overwrites(channel, roles_or_members, perm)
+            before = channel.overwrites
+            changed = [t.id for t, o in overwrites.items() if before.get(t) != o]
+            try:
+                await self.db.bulk_write([self.snapshot_update(channel, overwrites)])
+                await self.apply_overwrites(channel, overwrites, reason)
+            except discord.HTTPException:
+                failed, succeeded = succeeded, []
+            else:
+                held += changed
+        return succeeded, cancelled, failed, held
+
+    @staticmethod
+    def snapshot_update(channel: discord.abc.GuildChannel, overwrites: dict) -> UpdateOne:
+        """Build the write that records the overwrites ``overwrites`` is about to replace.
+
+        Targets already in the snapshot keep their recorded value, so locking a
+        channel twice still restores it to how it was before the first lock.
+        Each entry is ``[allow, deny, is_member]``, with ``None`` bits for
+        targets that had no overwrite.
+        """
+        before = channel.overwrites
+        changed = {}
+        for target, overwrite in overwrites.items():
+            prior = before.get(target)
+            if prior == overwrite:
+                continue
+            is_member = int(isinstance(target, (discord.Member, discord.User)))
+            if prior is None:
+                changed[str(target.id)] = [None, None, is_member]
+            else:
+                allow, deny = prior.pair()
+                changed[str(target.id)] = [allow.value, deny.value, is_member]
+
+        return UpdateOne(
+            {"_id": f"snapshot:{channel.id}"},
+            [
+                {
+                    "$set": {
+                        "type": "snapshot",
+                        "guild_id": channel.guild.id,
+                        "channel_id": channel.id,
+                        "overwrites": {"$mergeObjects": [{"$literal": changed}, "$overwrites"]},
+                    }
+                }
+            ],
+            upsert=True,
+        )
+
+    async def forget_snapshot(self, channel: discord.abc.GuildChannel, target_ids) -> None:
+        """Drop the snapshot entries of targets that were unlocked.
+
+        Once a target is unlocked by hand, its recorded overwrite is out of date
+        and restoring it later would undo any edits made since. The document is
+        removed when only the bot's own entry is left.
+        """
+        target_ids = [str(t) for t in target_ids]
+        if not target_ids:
+            return
+
+        snapshot = await self.db.find_one_and_update(
+            {"_id": f"snapshot:{channel.id}"},
+            {"$unset": {f"overwrites.{t}": "" for t in target_ids}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if snapshot is not None and set(snapshot.get("overwrites", {})) <= {str(channel.guild.me.id)}:
+            await self.db.delete_one({"_id": snapshot["_id"]})
+
+    async def restore_channel(self, channel: discord.abc.GuildChannel, snapshot: dict, reason: str = None) -> bool:
+        """Put back the overwrites recorded in ``snapshot`` with a single edit."""
+        overwrites = channel.overwrites
+        for target_id, (allow, deny, is_member) in snapshot["overwrites"].items():
+            target_id = int(target_id)
+            if is_member:
+                target = channel.guild.get_member(target_id) or discord.Object(target_id, type=discord.Member)
+            else:
+                target = channel.guild.get_role(target_id) or discord.Object(target_id, type=discord.Role)
+
+            overwrites.pop(target, None)
+            if allow is not None:
+                overwrites[target] = discord.PermissionOverwrite.from_pair(
+                    discord.Permissions(allow), discord.Permissions(deny)
+                )
+        return await self.apply_overwrites(channel, overwrites, reason)
+
+    @staticmethod
+    def lock_overwrites(channel: discord.abc.GuildChannel, roles, perm: str = None) -> dict:
+        """Return the overwrite map of ``channel`` with ``roles`` locked out of it."""
+        overwrites = channel.overwrites
+        perm = perm or ("send_messages" if isinstance(channel, discord.TextChannel) else "connect")
+        for role in roles:
+            current_perms = channel.overwrites_for(role)
+            if getattr(current_perms, perm) != False:
+                current_perms.update(**{perm: False})
+                overwrites[role] = current_perms
+
+        if perm == "send_messages" and overwrites != channel.overwrites:
+            my_perms = channel.overwrites_for(channel.guild.me)
+            if my_perms.send_messages != True:
+                my_perms.update(send_messages=True)
+                overwrites[channel.guild.me] = my_perms
+        return overwrites
+
+    @lock.command("slowmode")
+    @checks.has_permissions(PermissionLevel.MOD)
+    async def lock_slowmode(self, ctx: commands.Context, channel: Optional[LockableChannel], rate: int):
+        """
+        Automatically raise and lower slowmode based on activity.
+
+        `rate` is the number of messages per minute above which slowmode steps up.
+        It steps back down once activity drops below half of that.
+        Set `rate` to `0` to stop managing the channel.
+
+        **Examples:**
+        `{prefix}lock slowmode #general 40`
+        `{prefix}lock slowmode #general 0`
+        """
+        channel = channel or ctx.channel
+        state = self.slowmode.pop(channel.id, None)
+        if rate <= 0:
+            if state is None:
+                return await ctx.send(f"{channel.mention} does not have automatic slowmode.")
+            await self.db.delete_one({"_id": f"slowmode:{channel.id}"})
+            if channel.slowmode_delay != state["base"]:
+                await channel.edit(slowmode_delay=state["base"], reason=get_audit_reason(ctx.author))
+            return await ctx.send(f"Automatic slowmode disabled in {channel.mention}.")
+
+        base = state["base"] if state else channel.slowmode_delay
+        step = state["step"] if state else 0
+        self.enroll_slowmode(channel.id, rate, base, step)
+        await self.db.update_one(
+            {"_id": f"slowmode:{channel.id}"},
+            {"$set": {"type": "slowmode", "channel_id": channel.id, "rate": rate, "base": base, "step": step}},
+            upsert=True,
+        )
+        await ctx.send(f"{channel.mention} will slow down above {rate} messages per minute.")
+
+    @lock.command("audit")
+    @checks.has_permissions(PermissionLevel.MOD)
+    async def lock_audit(self, ctx: commands.Context, *roles: LockableRole):
+        """
+        Check which channels are still open.
+
+        Lists channels the given roles (`@everyone` by default) can still talk in,
+        and channels whose access differs from their category.
+
+        **Example:**
+        `{prefix}lock audit @members`
+        """
+        roles = roles or [ctx.guild.default_role]
+        channels = [
+            c for c in ctx.guild.channels
+            if isinstance(c, (discord.TextChannel, discord.VoiceChannel, discord.CategoryChannel))
+        ]
+        index, matrix = self.permission_matrix(ctx.guild, channels)
+        checked = 0
+        for role in roles:
+            checked |= 1 << index[role.id]
+        view, send, connect = AUDIT_FLAGS
+
+        def talk(channel, row):
+            return row[view] & row[connect if isinstance(channel, discord.VoiceChannel) else send]
+
+        unlocked = []
+        inconsistent = []
+        for channel, row in matrix.items():
+            if isinstance(channel, discord.CategoryChannel):
+                continue
+            open_for = talk(channel, row) & checked
+            if open_for:
+                names = [inline(r.name) for r in roles if open_for >> index[r.id] & 1]
+                unlocked.append(f"{channel.mention}: open for {humanize_list(names)}")
+            if channel.category in matrix:
+                differs = talk(channel, row) ^ talk(channel, matrix[channel.category])
+                if differs:
+                    count = bin(differs).count("1")
+                    inconsistent.append(
+                        f"{channel.mention}: {count} role{'s' if count != 1 else ''} differ from **{channel.category}**"
+                    )
+
+        lines = [f"**Unlocked ({len(unlocked)})**", *(unlocked or ["None"])]
+        lines += ["", f"**Out of sync with category ({len(inconsistent)})**", *(inconsistent or ["None"])]
+        page = ""
+        for line in lines:
+            if len(page) + len(line) >= 1990:
+                await ctx.send(page)
+                page = ""
+            page += line + "\n"
+        await ctx.send(page)
+
+    @staticmethod
+    def permission_matrix(guild: discord.Guild, channels):
+        """Compute effective permissions of every role in every channel as packed ints.
+
+        Returns the bit index of each role id and, per channel, a dict of
+        ``AUDIT_FLAGS`` flag to a mask with bit ``i`` set when role ``i`` (on
+        top of ``@everyone``) has that permission. Member overwrites are ignored.
+        """
+        roles = guild.roles
+        full = (1 << len(roles)) - 1
+        index = {r.id: i for i, r in enumerate(roles)}
+        everyone = guild.default_role.permissions.value
+
+        admin = 0
+        base = dict.fromkeys(AUDIT_FLAGS, 0)
+        for i, role in enumerate(roles):
+            value = role.permissions.value | everyone
+            if value & ADMINISTRATOR:
+                admin |= 1 << i
+            for flag in AUDIT_FLAGS:
+                if value & flag:
+                    base[flag] |= 1 << i
+
+        matrix = {}
+        for channel in channels:
+            allow = dict.fromkeys(AUDIT_FLAGS, 0)
+            deny = dict.fromkeys(AUDIT_FLAGS, 0)
+            everyone_allow = everyone_deny = 0
+            for target, overwrite in channel.overwrites.items():
+                if not isinstance(target, discord.Role):
+                    continue
+                allowed, denied = (p.value for p in overwrite.pair())
+                if target.id == guild.id:
+                    everyone_allow, everyone_deny = allowed, denied
+                bit = 1 << index[target.id]
+                for flag in AUDIT_FLAGS:
+                    if allowed & flag:
+                        allow[flag] |= bit
+                    if denied & flag:
+                        deny[flag] |= bit
+
+            row = {}
+            for flag in AUDIT_FLAGS:
+                mask = base[flag]
+                if everyone_deny & flag:
+                    mask = 0
+                if everyone_allow & flag:
+                    mask = full
+                row[flag] = (mask & ~deny[flag] | allow[flag] | admin) & full
+            matrix[channel] = row
+        return index, matrix
+
     @checks.has_permissions(PermissionLevel.OWNER) # unstable, incomplete
     @lock.command("perms")
     async def lock_perms(
@@ -417,6 +1032,10 @@ class Lock(commands.Cog):
 
                 else:
                     cancelled.append(inline(role.name))
+
+        await self.forget_snapshot(channel, [r.id for r in roles_or_members])
+        await self.cancel_unlocks([channel.id])
+
         msg = ""
         if succeeded:
             msg += f"{channel.mention} has unlocked for {humanize_list(succeeded)} with state `{'true' if state else 'default'}`.\n"
@@ -451,38 +1070,25 @@ class Lock(commands.Cog):
         except discord.Forbidden:
             return
 
+        if channel is None or not roles_or_members:
+            return await ctx.send_help(ctx.command)
+
         roles_or_members = roles_or_members[:10]
-        members = []
         succeeded = []
         cancelled = []
         failed = []
         reason = get_audit_reason(ctx.author)
 
-        if isinstance(channel, discord.TextChannel):
-            for role in roles_or_members:
-                current_perms = channel.overwrites_for(role)
-                if current_perms.send_messages != True:
-                    cancelled.append(inline(role.name))
-                else:
-                    current_perms.update(view_channel= None, send_messages=None)
-                    try:
-                        await channel.set_permissions(role, overwrite=current_perms, reason=reason)
-                        succeeded.append(inline(role.name))
-                    except:
-                        failed.append(inline(role.name))
-        elif isinstance(channel, discord.VoiceChannel):
-            for role in roles_or_members:
-                current_perms = channel.overwrites_for(role)
-                if current_perms.connect != True:
-                    current_perms.update(view_channel= None, connect=None)
-                    try:
-                        await channel.set_permissions(role, overwrite=current_perms, reason=reason)
-                        succeeded.append(inline(role.name))
-                    except:
-                        failed.append(inline(role.name))
-
-                else:
-                    cancelled.append(inline(role.name))
+        overwrites = channel.overwrites
+        perm = "send_messages" if isinstance(channel, discord.TextChannel) else "connect"
+        for role in roles_or_members:
+            current_perms = channel.overwrites_for(role)
+            if getattr(current_perms, perm) != True:
+                cancelled.append(inline(role.name))
+            else:
+                current_perms.update(view_channel=None, **{perm: None})
+                overwrites[role] = current_perms
+                succeeded.append(inline(role.name))
 
         if len(succeeded) != 0 or len(cancelled) != 0:
             for r in channel.changed_roles:
@@ -491,9 +1097,12 @@ class Lock(commands.Cog):
                 else:
                     state = None
 
-                await channel.set_permissions(
-                    r, view_channel=state, send_messages=state
-                )
+                overwrites[r] = discord.PermissionOverwrite(view_channel=state, send_messages=state)
+
+        try:
+            await self.apply_overwrites(channel, overwrites, reason)
+        except discord.HTTPException:
+            failed, succeeded = succeeded, []
 
                 #for m in channel.members:
                     #if r not in m.roles:
@@ -560,6 +1169,9 @@ class Lock(commands.Cog):
                 except:
                     failed.append(inline(role.name))
 
+        await self.forget_snapshot(channel, [r.id for r in roles_or_members])
+        await self.cancel_unlocks([channel.id])
+
         msg = ""
         if succeeded:
             msg += f"{channel.mention} has unlocked viewing for {humanize_list(succeeded)} with state `{'true' if state else 'default'}`.\n"
@@ -613,6 +1225,61 @@ class Lock(commands.Cog):
         if msg:
             await ctx.send("\n".join(msg))
 
+    @unlock.command("restore", aliases=["--restore"])
+    @checks.has_permissions(PermissionLevel.MOD)
+    async def unlock_restore(
+        self,
+        ctx: commands.Context,
+        *,
+        scope: Union[Literal["all"], LockableChannel, discord.VoiceChannel, discord.CategoryChannel] = None,
+    ):
+        """
+        Restore the overwrites a channel had before it was locked.
+
+        Pass a category or `all` to restore every channel locked by a lockdown.
+
+        **Examples:**
+        `{prefix}unlock --restore #general`
+        `{prefix}unlock restore Community`
+        `{prefix}unlock restore all`
+        """
+        await ctx.trigger_typing()
+        if scope == "all":
+            query = {"type": "snapshot", "guild_id": ctx.guild.id}
+        elif isinstance(scope, discord.CategoryChannel):
+            query = {"_id": {"$in": [f"snapshot:{c.id}" for c in scope.channels]}}
+        else:
+            query = {"_id": f"snapshot:{(scope or ctx.channel).id}"}
+
+        snapshots = await self.db.find(query).to_list(None)
+        if not snapshots:
+            return await ctx.send("There is no saved lock to restore.")
+
+        reason = get_audit_reason(ctx.author, "Restored from lock snapshot", shorten=True)
+        semaphore = asyncio.Semaphore(LOCKDOWN_CONCURRENCY)
+        failed = []
+
+        async def restore(snapshot):
+            channel = ctx.guild.get_channel(snapshot["channel_id"])
+            if channel is None:
+                return
+            async with semaphore:
+                try:
+                    await self.restore_channel(channel, snapshot, reason)
+                except discord.HTTPException:
+                    failed.append(snapshot)
+
+        await asyncio.gather(*map(restore, snapshots))
+        restored = [s for s in snapshots if s not in failed]
+        await self.db.delete_many({"_id": {"$in": [s["_id"] for s in restored]}})
+        await self.cancel_unlocks([s["channel_id"] for s in restored])
+
+        msg = f"Restored {len(restored)} channel{'s' if len(restored) != 1 else ''} to their state before locking."
+        if failed:
+            channels = humanize_list([f"<#{snapshot['channel_id']}>" for snapshot in failed])
+            msg += f"\nI failed to restore {channels}."
+        await ctx.send(msg)
+
     @checks.has_permissions(PermissionLevel.OWNER) # unstable, incomplete
     @unlock.command("perms")
     async def unlock_perms(
@@ -639,6 +1306,8 @@ class Lock(commands.Cog):
         for role in roles_or_members:
             overwrite = self.update_overwrite(ctx, channel.overwrites_for(role), perms)
             await channel.set_permissions(role, overwrite=overwrite[0])
+        await self.forget_snapshot(channel, [r.id for r in roles_or_members])
+        await self.cancel_unlocks([channel.id])
         msg = ""
         if overwrite[1]:
             msg += (
@@ -653,6 +1322,20 @@ class Lock(commands.Cog):
         if msg:
             await ctx.send(msg)
 
+    @staticmethod
+    async def apply_overwrites(
+        channel: discord.abc.GuildChannel, overwrites: dict, reason: str = None
+    ) -> bool:
+        """Apply a complete overwrite map to a channel in one request.
+
+        Returns ``False`` without calling the API when the map already
+        matches the channel's current overwrites.
+        """
+        if overwrites == channel.overwrites:
+            return False
+        await channel.edit(overwrites=overwrites, reason=reason)
+        return True
+
     @staticmethod
     def update_overwrite(
         ctx: commands.Context, overwrite: discord.PermissionOverwrite, permissions: dict
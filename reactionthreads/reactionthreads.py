@@ -4,16 +4,94 @@
 
 import asyncio
 import copy
+import hashlib
+import io
+import json
+import time
+import unicodedata
+from collections import Counter
 
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord.ext.commands.view import StringView
 
 from core import checks
-from core.models import DummyMessage, PermissionLevel
+from core.models import DummyMessage, PermissionLevel, getLogger
 from core.utils import normalize_alias
 
-from typing import Optional, Literal
+from types import MappingProxyType
+from typing import Literal, Mapping, NamedTuple, Optional, Tuple
+
+logger = getLogger(__name__)
+
+
+RESERVED_KEYS = ('enabled', 'mode', 'placeholder', 'label', 'color', 'content', 'command', '_id')
+MENU_TIMEOUT = 120
+MAX_OPTIONS = 20
+LATENCY_BUCKETS = (5, 10, 20, 30, 60, 90, MENU_TIMEOUT)
+# code points that only appear inside an emoji sequence: ZWJ, variation selectors and the keycap
+EMOJI_MODIFIERS = frozenset('\u200d\ufe0e\ufe0f\u20e3')
+# emojis outside the symbol category
+EMOJI_PUNCTUATION = frozenset('\u203c\u2049\u3030\u303d')
+
+
+def allow_menu_bypass(command):
+    """
+    Wrap the permission level checks of a command and its subcommands so they pass for
+    contexts flagged with `menu_bypass`. Every other check, cooldown and concurrency limit still applies.
+    """
+    commands_ = [command, *command.walk_commands()] if isinstance(command, commands.Group) else [command]
+    for cmd in commands_:
+        if any(hasattr(c, 'permission_level') and not hasattr(c, 'menu_bypass') for c in cmd.checks):
+            cmd.checks = [
+                bypassable(c) if hasattr(c, 'permission_level') and not hasattr(c, 'menu_bypass') else c
+                for c in cmd.checks
+            ]
+
+
+def bypassable(predicate):
+    async def check(ctx):
+        if getattr(ctx, 'menu_bypass', False):
+            return True
+        return await discord.utils.maybe_coroutine(predicate, ctx)
+
+    check.permission_level = predicate.permission_level
+    check.menu_bypass = True
+    return check
+
+
+def is_unicode_emoji(text):
+    """
+    Check without a request that every code point of `text` can be part of an emoji:
+    symbols, regional indicators, skin tones, tags, joiners, variation selectors and keycaps.
+    """
+    symbol = False
+    for i, c in enumerate(text):
+        if c in EMOJI_MODIFIERS or '\U0001f3fb' <= c <= '\U0001f3ff' or '\U000e0020' <= c <= '\U000e007f':
+            continue
+        if c in '#*0123456789':
+            # only the base of a keycap, like 1\ufe0f\u20e3
+            if not text[i + 1:].lstrip('\ufe0f').startswith('\u20e3'):
+                return False
+        elif unicodedata.category(c) != 'So' and c not in EMOJI_PUNCTUATION:
+            return False
+        symbol = True
+    return symbol
+
+
+class MenuNode(NamedTuple):
+    """One compiled level of the menu tree"""
+    id: int
+    path: str
+    emoji: Optional[str]
+    label: str
+    content: Optional[str]
+    command: Optional[str]
+    children: Mapping[int, "MenuNode"]
+    reactions: Mapping[str, "MenuNode"]
+    options: Tuple[discord.SelectOption, ...]
+    view: Optional[discord.ui.View]
+
 
 class ReactionThreads(commands.Cog):
     """Reaction Menu Tree for Threads"""
@@ -29,6 +107,13 @@ class ReactionThreads(commands.Cog):
         self.task = self.bot.loop.create_task(self.cog_load())
         self.global_config = None
         self.color = None
+        self.sessions = {}
+        self.root = None
+        self.nodes = {}
+        self.tree_version = None
+        self.plans = {}
+        self.pending_stats = Counter()
+        self.flush_stats.start()
 
     async def cog_load(self):
         self.global_config = await self.db.find_one({"_id": "reactionthreads"})
@@ -63,6 +148,79 @@ class ReactionThreads(commands.Cog):
             elif self.global_config['color'] == 'blue':
                 self.color = discord.ButtonStyle.blurple
 
+        self.compile_menus()
+        await self.restore_sessions()
+
+    def compile_menus(self):
+        """Build the immutable menu tree with prebuilt components from the config"""
+        self.root = self.compile_node(self.global_config, None, [0], 'menu')
+        self.plans = {}
+
+        self.nodes = {}
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            self.nodes[node.id] = node
+            stack.extend(node.children.values())
+
+        # node ids are only meaningful for the config they were compiled from
+        tree = {k: v for k, v in self.global_config.items() if k != 'enabled'}
+        self.tree_version = hashlib.sha1(json.dumps(tree, default=str).encode()).hexdigest()
+        self.bot.loop.create_task(self.prune_stats())
+
+    def compile_node(self, config, emoji, counter, path):
+        node_id = counter[0]
+        counter[0] += 1
+
+        children = [
+            self.compile_node(v, e, counter, f'{path}/{e}')
+            for e, v in config.items()
+            if e not in RESERVED_KEYS and isinstance(v, dict)
+        ]
+
+        options = []
+        view = None
+        if children:
+            view = discord.ui.View(timeout=None)
+            for child in children:
+                if self.global_config['mode'] == 'button':
+                    view.add_item(discord.ui.Button(style=self.color, label=child.label, custom_id=f'rthread:{child.id}', emoji=child.emoji))
+                elif self.global_config['mode'] == 'dropdown':
+                    options.append(discord.SelectOption(label=child.label, emoji=child.emoji, value=str(child.id)))
+
+            if self.global_config['mode'] == 'dropdown':
+                view.add_item(
+                    discord.ui.Select(
+                        custom_id=f'rthread:{node_id}',
+                        placeholder=self.global_config.get('placeholder', "Choose an option..."), min_values=1, max_values=1,
+                        options=options,
+                    )
+                )
+
+            # the view is only a component template, selections are routed by on_interaction
+            view.stop()
+            if len(view.children) == 0:
+                view = None
+
+        def setting(key):
+            value = config.get(key)
+            if value is None or value.lower() == 'none':
+                return None
+            return value
+
+        return MenuNode(
+            id=node_id,
+            path=path,
+            emoji=emoji,
+            label=setting('label') or "\u200b",
+            content=setting('content'),
+            command=setting('command'),
+            children=MappingProxyType({c.id: c for c in children}),
+            reactions=MappingProxyType({c.emoji: c for c in children}),
+            options=tuple(options),
+            view=view,
+        )
+
     async def config_update(self):
         await self.db.find_one_and_update(
             {"_id": "reactionthreads"},
@@ -72,104 +230,242 @@ class ReactionThreads(commands.Cog):
 
     def cog_unload(self):
         self.task.cancel()
+        for session in self.sessions.values():
+            session['timeout'].cancel()
+        self.flush_stats.cancel()
+        self.bot.loop.create_task(self.write_stats())
+
+    def count(self, node, field, amount=1):
+        # keyed by the emoji path, so stats survive reordering options or restyling the menu
+        self.pending_stats[f'{node.path}.{field}'] += amount
 
-    async def send_menus(self, thread, creator, category, initial_message, config):
+    @tasks.loop(seconds=30)
+    async def flush_stats(self):
+        await self.write_stats()
+
+    async def write_stats(self):
+        """Write the counters gathered since the last flush in one update"""
+        if not self.pending_stats:
+            return
+
+        pending, self.pending_stats = self.pending_stats, Counter()
+        try:
+            await self.db.update_one(
+                {'_id': 'stats'},
+                {'$inc': {f'nodes.{k}': v for k, v in pending.items()}},
+                upsert=True,
+            )
+        except Exception as e:
+            logger.error(f"Failed to save menu stats, retrying on the next flush: {e}")
+            self.pending_stats.update(pending)
+
+    async def prune_stats(self):
+        """Drop the counters of options that are no longer in the menu"""
+        data = await self.db.find_one({'_id': 'stats'})
+        if data is None:
+            return
+
+        paths = {node.path for node in self.nodes.values()}
+        stale = {f'nodes.{p}': '' for p in data.get('nodes', {}) if p not in paths}
+        if 'trees' in data:
+            stale['trees'] = ''
+        if stale:
+            await self.db.update_one({'_id': 'stats'}, {'$unset': stale})
+
+    async def send_menus(self, thread, creator, category, initial_message, node):
         if initial_message:
             message = DummyMessage(copy.copy(initial_message))
         else:
             message = [m async for m in thread.channel.history(limit=1)][0]
 
         message.author = self.bot.modmail_guild.me
-        message.content = config['content']
+        message.content = node.content
         msgs, _ = await thread.reply(message)
-        main_recipient_msg = None
+        if not node.children:
+            return
 
+        main_recipient_msg = None
         for m in msgs:
             if m.channel.recipient == thread.recipient:
                 main_recipient_msg = m
                 break
 
-        view = discord.ui.View()
-        options = []
-        for e in config.keys():
-
-            if e in ['enabled', 'mode', 'placeholder', 'label', 'color', 'content', 'command', '_id']:
-                    continue
-
-            if 'label' in config[e] and config[e]['label'].lower() != 'none':
-                label = config[e]['label']
-            else:
-                label = "\u200b"
+        if self.global_config['mode'] == 'reaction':
+            for e in node.reactions:
+                await main_recipient_msg.add_reaction(e)
+                await asyncio.sleep(0.3)
+        elif node.view:
+            await main_recipient_msg.edit(view=node.view)
+
+        expires_at = time.time() + MENU_TIMEOUT
+        self.count(node, 'shown')
+        self.add_session(main_recipient_msg, node, expires_at, thread.recipient.id, thread=thread, message=message,
+            creator=creator, category=category, initial_message=initial_message)
+        await self.db.insert_one({
+            '_id': f'session:{main_recipient_msg.id}',
+            'type': 'session',
+            'thread_id': thread.channel.id,
+            'recipient_id': thread.recipient.id,
+            'channel_id': main_recipient_msg.channel.id,
+            'message_id': main_recipient_msg.id,
+            'node': node.id,
+            'tree': self.tree_version,
+            'expires_at': expires_at,
+        })
+
+    def add_session(self, menu, node, expires_at, recipient_id, **kwargs):
+        self.sessions[menu.id] = {
+            'thread': None,
+            'message': None,
+            'creator': None,
+            'category': None,
+            'initial_message': None,
+            **kwargs,
+            'recipient_id': recipient_id,
+            'menu': menu,
+            'node': node,
+            'timeout': self.bot.loop.call_later(max(expires_at - time.time(), 0), self.expire_menu, menu.id),
+        }
+
+    async def restore_sessions(self):
+        """Re-attach the dispatcher to menus that were open before a restart"""
+        now = time.time()
+        stale = []
+        async for x in self.db.find({'type': 'session'}):
+            node = self.nodes.get(x['node'])
+            if x['expires_at'] <= now or x['tree'] != self.tree_version or node is None:
+                stale.append(x['_id'])
+            elif x['message_id'] not in self.sessions:
+                menu = self.bot.get_partial_messageable(x['channel_id']).get_partial_message(x['message_id'])
+                self.add_session(menu, node, x['expires_at'], x['recipient_id'])
+
+        if stale:
+            await self.db.delete_many({'_id': {'$in': stale}})
+
+    async def resolve_session(self, session):
+        """Look up the thread and reply message of a session restored after a restart"""
+        if session['thread'] is None:
+            session['thread'] = await self.bot.threads.find(recipient_id=session['recipient_id'])
+            if session['thread'] is None:
+                return False
+
+        if session['message'] is None:
+            message = [m async for m in session['thread'].channel.history(limit=1)][0]
+            message.author = self.bot.modmail_guild.me
+            session['message'] = message
+        return True
+
+    def expire_menu(self, message_id):
+        session = self.sessions.pop(message_id, None)
+        if session:
+            self.count(session['node'], 'timeouts')
+            self.bot.loop.create_task(self.timeout_menu(message_id, session))
+
+    async def timeout_menu(self, message_id, session):
+        await self.db.delete_one({'_id': f'session:{message_id}'})
+        if not await self.resolve_session(session):
+            return
+
+        session['message'].content = 'No option selected... timing out'
+        await session['menu'].edit(view=None)
+        await session['thread'].reply(session['message'])
+
+    async def select_option(self, message_id, user_id, choice):
+        """Route a menu selection to its session, ignoring anything that is not a valid choice"""
+        session = self.sessions.get(message_id)
+        if session is None or user_id != session['recipient_id']:
+            return False
+
+        node = session['node']
+        option = node.children.get(choice) if isinstance(choice, int) else node.reactions.get(choice)
+        if option is None:
+            return False
+
+        del self.sessions[message_id]
+        session['timeout'].cancel()
+
+        latency = MENU_TIMEOUT - session['timeout'].when() + self.bot.loop.time()
+        bucket = next((b for b in LATENCY_BUCKETS if latency <= b), LATENCY_BUCKETS[-1])
+        self.count(option, 'picks')
+        self.count(node, f'latency.{bucket}')
+        await self.db.delete_one({'_id': f'session:{message_id}'})
+        if await self.resolve_session(session):
+            await self.run_option(session, option)
+        return True
+
+    async def run_option(self, session, node):
+        thread = session['thread']
+        message = session['message']
+
+        await session['menu'].delete()
+        for text, index, invoked_with, command in self.command_plan(node):
+            if command is None:
+                continue
+            view = StringView(text)
+            view.index = view.previous = index
+            ctx = commands.Context(prefix=self.bot.prefix, view=view, bot=self.bot, message=message)
+            ctx.thread = thread
+            ctx.invoked_with = invoked_with
+            ctx.command = command
+            # the recipient picked the option, so the menu author's command must run for them
+            ctx.menu_bypass = True
+            await self.bot.invoke(ctx)
+
+        if node.content:
+            await self.send_menus(thread, session['creator'], session['category'], session['initial_message'], node)
+
+    def command_plan(self, node):
+        """
+        Resolve the command aliases of an option once and cache them per node.
+        Aliases that don't resolve are kept too, so a command loaded later is picked up.
+        """
+        plan = self.plans.get(node.id)
+        if plan is not None and all(self.bot.all_commands.get(p[2]) is p[3] for p in plan):
+            return plan
+
+        plan = []
+        if node.command:
+            for alias in normalize_alias(node.command):
+                view = StringView(alias)
+                invoked_with = view.get_word().lower()
+                command = self.bot.all_commands.get(invoked_with)
+                if command:
+                    allow_menu_bypass(command)
+                plan.append((alias, view.index, invoked_with, command))
+
+        plan = tuple(plan)
+        self.plans[node.id] = plan
+        return plan
 
-            if self.global_config['mode'] == 'button':
-                view.add_item(discord.ui.Button(style=self.color, label=label, custom_id=e, emoji=e))
+    @commands.Cog.listener()
+    async def on_interaction(self, interaction):
+        if interaction.type != discord.InteractionType.component or interaction.message is None:
+            return
 
-            elif self.global_config['mode'] == 'dropdown':
-                options.append(discord.SelectOption(label=label, emoji=e, value=e))
+        custom_id = interaction.data.get('custom_id', '')
+        if not custom_id.startswith('rthread:'):
+            return
 
-            elif self.global_config['mode'] == 'reaction':
-                await main_recipient_msg.add_reaction(e)
-                await asyncio.sleep(0.3)
+        if interaction.data.get('values'):
+            choice = interaction.data['values'][0]
+        else:
+            choice = custom_id[len('rthread:'):]
+        if not choice.isdigit():
+            return
+        choice = int(choice)
 
-        if self.global_config['mode'] == 'dropdown':
-            view.add_item(
-                discord.ui.Select(
-                    custom_id="reactionthreaddrop",
-                    placeholder=self.global_config['placeholder'] if 'placeholder' in self.global_config else "Choose an option...", min_values=1, max_values=1,
-                        options = options
-                    )
-                )
+        if interaction.message.id not in self.sessions:
+            return await interaction.response.send_message('This menu has expired.', ephemeral=True)
 
-        if len(view.children) != 0:
-            await main_recipient_msg.edit(view=view)
+        await interaction.response.defer()
+        await self.select_option(interaction.message.id, interaction.user.id, choice)
 
-        try:
-            if self.global_config['mode'] == 'button':
-                inter = await self.bot.wait_for('interaction', check=lambda i: i.message.id == main_recipient_msg.id and i.user == thread.recipient and str(i.data['custom_id']) in config.keys(), timeout=120)
-                config = config[str(inter.data['custom_id'])]
-
-            elif self.global_config['mode'] == 'dropdown':
-                inter = await self.bot.wait_for('interaction', check=lambda i: i.message.id == main_recipient_msg.id and i.user == thread.recipient and str(i.data['values'][0]) in config.keys(), timeout=120)
-                config = config[str(inter.data['values'][0])]
-            
-            elif self.global_config['mode'] == 'reaction':
-                reaction, _ = await self.bot.wait_for('reaction_add', check=lambda r, u: r.message == main_recipient_msg and u == thread.recipient and str(r.emoji) in config.keys(), timeout=120)
-                config = config[str(reaction.emoji)]
-
-        except asyncio.TimeoutError:
-            message.content = 'No option selected... timing out'
-            await main_recipient_msg.edit(view=None)
-            await thread.reply(message)
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload):
+        if payload.message_id not in self.sessions:
+            return
 
-        else:
-            await main_recipient_msg.delete()
-            if 'command' in config and config['command'].lower() != 'none':
-                alias = config['command']
-                ctxs = []
-                if alias is not None:
-                    ctxs = []
-                    aliases = normalize_alias(alias)
-                    for alias in aliases:
-                        view = StringView(self.bot.prefix + alias)
-                        ctx_ = commands.Context(prefix=self.bot.prefix, view=view, bot=self.bot, message=message)
-                        ctx_.thread = thread
-                        discord.utils.find(view.skip_string, await self.bot.get_prefix())
-                        ctx_.invoked_with = view.get_word().lower()
-                        ctx_.command = self.bot.all_commands.get(ctx_.invoked_with)
-                        ctxs += [ctx_]
-
-                for ctx in ctxs:
-                    if ctx.command:
-                        old_checks = copy.copy(ctx.command.checks)
-                        ctx.command.checks = [checks.has_permissions(PermissionLevel.INVALID)]
-
-                        await self.bot.invoke(ctx)
-
-                        ctx.command.checks = old_checks
-                        continue
-
-            if 'content' in config and config['content'].lower() != 'none':
-                await self.send_menus(thread, creator, category, initial_message, config)
+        await self.select_option(payload.message_id, payload.user_id, str(payload.emoji))
 
     async def generate_menus(self, ctx, config, main):
         if main:
@@ -253,7 +549,7 @@ class ReactionThreads(commands.Cog):
         else:
             i = 0
             for k, v in config.items():
-                if k in ['enabled', 'mode', 'placeholder', 'label', 'color', 'content', 'command', '_id']:
+                if k in RESERVED_KEYS:
                     continue
                 i += 1
 
@@ -343,8 +639,8 @@ class ReactionThreads(commands.Cog):
 
     @commands.Cog.listener()
     async def on_thread_ready(self, thread, creator, category, initial_message):
-        if self.global_config['enabled']:
-            await self.send_menus(thread, creator, category, initial_message, self.global_config)
+        if self.global_config['enabled'] and self.root and self.root.content:
+            await self.send_menus(thread, creator, category, initial_message, self.root)
 
     @checks.has_permissions(PermissionLevel.MOD)
     @commands.group(aliases=['rthread', 'threadmenu'], invoke_without_command=True)
@@ -361,6 +657,7 @@ class ReactionThreads(commands.Cog):
             try:
                 await self.generate_menus(ctx, self.global_config, True)
             except asyncio.TimeoutError:
+                self.compile_menus()
                 await ctx.send(
                     embed=await self.generate_embed(
                         'Timeout', 'Re-run the command to create a menu.'
@@ -368,12 +665,159 @@ class ReactionThreads(commands.Cog):
                 )
             else:
                 await self.config_update()
+                self.compile_menus()
                 await ctx.send(
                     embed=await self.generate_embed(
                         'Done', 'New Menu created successfully'
                     )
                 )
 
+    @checks.has_permissions(PermissionLevel.MOD)
+    @reactionthreads.command(name='stats')
+    async def reactionthreads_stats(self, ctx):
+        """Shows how often each option is picked, timeouts and how long members take to choose"""
+        await self.write_stats()
+        data = await self.db.find_one({'_id': 'stats'}) or {}
+        stats = data.get('nodes', {})
+
+        lines = []
+
+        def render(node, depth):
+            node_stats = stats.get(node.path, {})
+            if node is not self.root:
+                label = node.label if node.label != "\u200b" else ''
+                lines.append(f"{'  ' * (depth - 1)}{node.emoji} {label} - **{node_stats.get('picks', 0)}**")
+            if node.children:
+                latency = node_stats.get('latency', {})
+                total = sum(latency.values())
+                median = None
+                seen = 0
+                for bucket in LATENCY_BUCKETS:
+                    seen += latency.get(str(bucket), 0)
+                    if total and seen * 2 >= total:
+                        median = bucket
+                        break
+                lines.append(
+                    f"{'  ' * depth}*shown {node_stats.get('shown', 0)}, timed out {node_stats.get('timeouts', 0)}"
+                    + (f", half chose within {median}s*" if median else '*')
+                )
+                for child in node.children.values():
+                    render(child, depth + 1)
+
+        render(self.root, 0)
+        description = '\n'.join(lines)
+        if len(description) > 4000:
+            description = description[:4000] + '\n...'
+
+        await ctx.send(embed=await self.generate_embed('Menu Stats', description or 'No menu set'))
+
+    @checks.has_permissions(PermissionLevel.MOD)
+    @reactionthreads.command(name='export')
+    async def reactionthreads_export(self, ctx):
+        """Sends the current menu as a JSON file, which can be loaded again with `rthread import`"""
+        tree = {k: v for k, v in self.global_config.items() if k not in ('_id', 'enabled')}
+        data = io.BytesIO(json.dumps(tree, indent=2, ensure_ascii=False).encode())
+        await ctx.send(file=discord.File(data, filename='reactionthreads.json'))
+
+    @checks.has_permissions(PermissionLevel.MOD)
+    @reactionthreads.command(name='import')
+    async def reactionthreads_import(self, ctx):
+        """
+        Replaces the menu with the JSON file attached to the command
+
+        The file uses the same layout as `rthread export`.
+        """
+        if not ctx.message.attachments:
+            return await ctx.send_help(ctx.command)
+
+        try:
+            tree = json.loads(await ctx.message.attachments[0].read())
+        except (discord.HTTPException, UnicodeDecodeError, ValueError) as e:
+            return await ctx.send(embed=await self.generate_embed('Invalid file', f'Could not read the menu: {e}'))
+
+        errors = []
+        emojis = set()
+        config = self.load_node(tree, 'Top menu', errors, emojis) if isinstance(tree, dict) else None
+        if config is None:
+            errors.append('Top menu: must be an object')
+        else:
+            for key in ('mode', 'color', 'placeholder'):
+                if key in tree:
+                    config[key] = tree[key]
+            if config.get('mode', 'reaction') not in ('reaction', 'dropdown', 'button'):
+                errors.append('`mode` must be one of reaction, dropdown or button')
+            if config.get('color', 'grey') not in ('red', 'blue', 'grey', 'green'):
+                errors.append('`color` must be one of red, blue, grey or green')
+
+        errors.extend(f'{emoji}: not a valid emoji' for emoji in self.invalid_emojis(emojis))
+        if errors:
+            description = '\n'.join(errors)
+            if len(description) > 4000:
+                description = description[:4000] + '\n...'
+            return await ctx.send(embed=await self.generate_embed('Invalid menu', description))
+
+        config['_id'] = 'reactionthreads'
+        config['enabled'] = self.global_config['enabled']
+        config.setdefault('mode', self.global_config.get('mode', 'reaction'))
+        config.setdefault('color', self.global_config.get('color', 'grey'))
+        config.setdefault('placeholder', self.global_config.get('placeholder', 'Choose an option...'))
+        await self.db.replace_one({'_id': 'reactionthreads'}, config, upsert=True)
+
+        self.global_config = config
+        self.color = {
+            'green': discord.ButtonStyle.green,
+            'grey': discord.ButtonStyle.grey,
+            'red': discord.ButtonStyle.red,
+            'blue': discord.ButtonStyle.blurple,
+        }[config['color']]
+        self.compile_menus()
+        await ctx.send(embed=await self.generate_embed('Done', f'Menu imported with {len(self.nodes) - 1} options'))
+
+    def load_node(self, data, path, errors, emojis):
+        """Validate one menu level of an imported tree, collecting every problem instead of stopping at the first"""
+        if not isinstance(data, dict):
+            errors.append(f'{path}: must be an object')
+            return None
+
+        node = {}
+        for key in ('content', 'label', 'command'):
+            value = data.get(key)
+            if value is None:
+                node[key] = 'None'
+            elif isinstance(value, str):
+                node[key] = value
+            else:
+                errors.append(f'{path}: `{key}` must be text')
+                node[key] = 'None'
+
+        if len(node['label']) > 80:
+            errors.append(f'{path}: `label` is longer than 80 characters')
+
+        options = [(k, v) for k, v in data.items() if k not in RESERVED_KEYS]
+        if len(options) > MAX_OPTIONS:
+            errors.append(f'{path}: has more than {MAX_OPTIONS} options')
+        if options and node['content'] == 'None':
+            errors.append(f'{path}: a menu with options needs a `content` message')
+
+        for emoji, option in options:
+            emojis.add(emoji)
+            child = self.load_node(option, f'{path} > {emoji}', errors, emojis)
+            if child is not None:
+                node[emoji] = child
+        return node
+
+    def invalid_emojis(self, emojis):
+        """Return the emojis that can't be used as menu options"""
+        invalid = []
+        for emoji in emojis:
+            partial = discord.PartialEmoji.from_str(emoji)
+            if partial.id:
+                if self.bot.get_emoji(partial.id) is None:
+                    invalid.append(emoji)
+            elif not is_unicode_emoji(emoji):
+                invalid.append(emoji)
+        return invalid
+
     @checks.has_permissions(PermissionLevel.MOD)
     @reactionthreads.command(name='clear')
     async def reactionthreads_clear(self, ctx):
@@ -387,6 +831,7 @@ class ReactionThreads(commands.Cog):
         self.global_config['mode'] = mode
         await self.config_update()
         self.global_config = await self.db.find_one({"_id": "reactionthreads"})
+        self.compile_menus()
         await ctx.send(
             embed=await self.generate_embed(
                 'Done', 'Menu is cleared'
@@ -417,6 +862,7 @@ class ReactionThreads(commands.Cog):
 
         self.global_config['mode'] = mode
         await self.config_update()
+        self.compile_menus()
         await ctx.send(
             embed=await self.generate_embed(
                 'Mode', mode
@@ -443,6 +889,7 @@ class ReactionThreads(commands.Cog):
             self.color = discord.ButtonStyle.red
         elif color == 'blue':
             self.color = discord.ButtonStyle.blurple
+        self.compile_menus()
         await ctx.send(
             embed=await self.generate_embed(
                 'Color', color
@@ -457,6 +904,7 @@ class ReactionThreads(commands.Cog):
         """
         self.global_config['placeholder'] = placeholder
         await self.config_update()
+        self.compile_menus()
 
         await ctx.send(
             embed=await self.generate_embed(
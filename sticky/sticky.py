@@ -1,57 +1,241 @@
 import discord
 import calendar
+import hashlib
+import io
+import mmap
+import os
 import time
-from discord.ext import commands
+from collections import OrderedDict
+from pathlib import Path
+from discord.ext import commands, tasks
+from pymongo import UpdateOne
 from typing import Optional
 from core import checks
-from core.models import PermissionLevel
+from core.models import PermissionLevel, getLogger
+
+logger = getLogger(__name__)
+
+ATTACHMENT_LIMIT = 8000000
+CACHE_DIR = Path('temp') / 'sticky'
+CACHE_LIMIT = 512 * 1024 * 1024
+
+
+class MappedAttachment(io.RawIOBase):
+    """Read-only cursor over a shared memory-mapped cache file"""
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.pos, io.SEEK_END: len(self.buffer)}[whence]
+        self.pos = max(0, base + offset)
+        return self.pos
+
+    def readinto(self, b):
+        data = self.buffer[self.pos:self.pos + len(b)]
+        b[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
 
 class Sticky(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.db = bot.api.get_plugin_partition(self)
         self.allowed_mentions = discord.AllowedMentions(users=True, roles=False, everyone=False)
+        self.stickies = {}
+        self.dirty_counters = {}
+        self.webhooks = {}
+        self.cache_files = OrderedDict()
+        self.mapped = {}
+
+    async def cog_load(self):
+        self.stickies = {}
+        async for sticky in self.db.find({}):
+            self.stickies.setdefault(sticky['channel_id'], []).append(sticky)
+        self.cache_files = await self.bot.loop.run_in_executor(None, self.scan_cache)
+        if not self.flush_counters.is_running():
+            self.flush_counters.start()
+
+    def cog_unload(self):
+        self.flush_counters.cancel()
+        self.bot.loop.create_task(self.write_counters())
+        for buffer in self.mapped.values():
+            buffer.close()
+
+    @staticmethod
+    def scan_cache():
+        """Size of every cached attachment, least recently used first"""
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        for f in CACHE_DIR.glob('*.tmp'):
+            # left behind by a write that never finished
+            f.unlink(missing_ok=True)
+        files = sorted((f.stat().st_atime, f.name, f.stat().st_size) for f in CACHE_DIR.iterdir() if f.is_file())
+        return OrderedDict((name, size) for _, name, size in files)
+
+    @staticmethod
+    def write_cache_file(digest, data):
+        path = CACHE_DIR / digest
+        tmp = path.with_suffix('.tmp')
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+    async def cache_attachment(self, attachment: discord.Attachment):
+        """Download an attachment once and store it under its content hash"""
+        data = await attachment.read()
+        digest = hashlib.sha256(data).hexdigest()
+        if digest not in self.cache_files:
+            await self.bot.loop.run_in_executor(None, self.write_cache_file, digest, data)
+            self.cache_files[digest] = len(data)
+        self.cache_files.move_to_end(digest)
+        return {'hash': digest, 'filename': attachment.filename, 'spoiler': attachment.is_spoiler()}
+
+    def evict_cache(self, keep=()):
+        """Drop least recently used files that no sticky refers to until the cache fits its limit"""
+        total = sum(self.cache_files.values())
+        if total <= CACHE_LIMIT:
+            return
 
-    async def send_sticky(self, channel, author, content, embed, attachments):
-        if not attachments:
-            attachments = ""
+        referenced = {
+            a['hash']
+            for stickies in self.stickies.values()
+            for sticky in stickies
+            for a in sticky['msg'].get('attachments', ())
+        }
+        for digest in list(self.cache_files):
+            if total <= CACHE_LIMIT:
+                break
+            if digest in referenced or digest in keep:
+                continue
+            total -= self.cache_files.pop(digest)
+            buffer = self.mapped.pop(digest, None)
+            if buffer is not None:
+                buffer.close()
+            (CACHE_DIR / digest).unlink(missing_ok=True)
+
+        if total > CACHE_LIMIT:
+            logger.warning(f"Sticky attachment cache is over its limit with {total} bytes in use by stickies.")
+
+    def open_attachments(self, attachments):
+        """Build files for a repost from the memory-mapped cache, without downloading anything"""
+        files = []
+        for a in attachments:
+            buffer = self.mapped.get(a['hash'])
+            if buffer is None:
+                if a['hash'] not in self.cache_files:
+                    logger.warning(f"Sticky attachment {a['filename']} ({a['hash']}) is missing from the cache.")
+                    continue
+                if self.cache_files[a['hash']] == 0:
+                    buffer = b''
+                else:
+                    with open(CACHE_DIR / a['hash'], 'rb') as f:
+                        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self.mapped[a['hash']] = buffer
+            self.cache_files.move_to_end(a['hash'])
+            files.append(discord.File(MappedAttachment(buffer), filename=a['filename'], spoiler=a['spoiler']))
+        return files
+
+    async def repost_sticky(self, channel, sticky, author):
+        if e_dict:= sticky['msg']['embed_dict']:
+            e = discord.Embed.from_dict(e_dict)
+        else:
+            e = None
+
+        files = self.open_attachments(sticky['msg'].get('attachments', ()))
+        return await self.send_sticky(channel, author, sticky['msg']['content'], e, files)
+
+    @tasks.loop(seconds=5)
+    async def flush_counters(self):
+        await self.write_counters()
+
+    async def write_counters(self):
+        """Persist the counters that changed since the last flush in one batch"""
+        if not self.dirty_counters:
+            return
+
+        dirty, self.dirty_counters = self.dirty_counters, {}
+        try:
+            await self.db.bulk_write(
+                [UpdateOne({'_id': _id}, {'$set': {'counter': sticky['counter']}}) for _id, sticky in dirty.items()],
+                ordered=False,
+            )
+        except Exception as e:
+            logger.error(f"Failed to save sticky counters, retrying on the next flush: {e}")
+            # the records hold the live counters, so putting them back is enough
+            for _id, sticky in dirty.items():
+                self.dirty_counters.setdefault(_id, sticky)
+
+    def get_sticky(self, channel_id, msg_id):
+        for sticky in self.stickies.get(channel_id, ()):
+            if sticky['msg_id'] == msg_id:
+                return sticky
+        return None
+
+    async def update_sticky(self, sticky, **fields):
+        """Write-through update of a sticky in the index and the database"""
+        sticky.update(fields)
+        await self.db.update_one({'_id': sticky['_id']}, {'$set': fields})
+
+    def drop_stickies(self, channel_id, msg_id=None):
+        stickies = [x for x in self.stickies.get(channel_id, ()) if msg_id is not None and x['msg_id'] != msg_id]
+        if stickies:
+            self.stickies[channel_id] = stickies
+        else:
+            self.stickies.pop(channel_id, None)
+
+    async def get_webhook(self, channel):
+        """Resolve the bot's webhook for a channel once, then serve it from the cache"""
+        webhook = self.webhooks.get(channel.id)
+        if webhook is not None:
+            return webhook
 
-        webhook = None
         my_perms: discord.Permissions = channel.permissions_for(channel.guild.me)
         if my_perms.manage_webhooks:
             webhooks = await channel.webhooks()
             webhook = discord.utils.get(webhooks, name=self.bot.user.name, user=self.bot.user)
             if webhook is None:
                 webhook = await channel.create_webhook(name=self.bot.user.name)
+            self.webhooks[channel.id] = webhook
+        return webhook
 
+    @commands.Cog.listener()
+    async def on_webhooks_update(self, channel):
+        self.webhooks.pop(channel.id, None)
 
-        if embed:
-            if webhook:
-                msg2 = await webhook.send(
-                    content,
-                    embed=embed,
-                    files=attachments,
-                    avatar_url=author.display_avatar.url,
-                    username=author.display_name,
-                    allowed_mentions=self.allowed_mentions,
-                    wait=True,
-                )
-            else:
-                msg2: discord.Message = await channel.send(content, embed=embed)
+    async def send_sticky(self, channel, author, content, embed, attachments):
+        if not attachments:
+            attachments = []
 
-        else:
-            if webhook:
-                msg2 = await webhook.send(
+        for _ in range(2):
+            webhook = await self.get_webhook(channel)
+            if not webhook:
+                break
+            try:
+                return await webhook.send(
                     content,
+                    embed=embed,
                     files=attachments,
                     avatar_url=author.display_avatar.url,
                     username=author.display_name,
                     allowed_mentions=self.allowed_mentions,
                     wait=True,
                 )
-            else:
-                msg2: discord.Message = await channel.send(content)
+            except discord.NotFound:
+                # the cached webhook was deleted, look it up again once
+                self.webhooks.pop(channel.id, None)
+                for attachment in attachments:
+                    attachment.reset()
 
+        msg2: discord.Message = await channel.send(content, embed=embed)
         return msg2
 
     async def check_msg(self, channel: discord.TextChannel, msg: discord.Message, author):
@@ -62,16 +246,15 @@ class Sticky(commands.Cog):
         else:
             content = ""
 
-        if len(msg.attachments) > 0:
-            attachments = [await attachment.to_file() for attachment in msg.attachments if attachment.size <= 8000000]
+        attachments = [await self.cache_attachment(attachment) for attachment in msg.attachments if attachment.size <= ATTACHMENT_LIMIT]
+        # evict only once every file of this sticky is cached, none of them is referenced yet
+        self.evict_cache(keep={a['hash'] for a in attachments})
 
-            bad_attachments = [f'`<Bad File: {attachment.filename} | File Size: {attachment.size}>`' for attachment in msg.attachments if attachment.size > 8000000]
-            if bad_attachments:
-                if content:
-                    content += '\n'
-                content += '\n'.join(bad_attachments)
-        else:
-            attachments = ""
+        bad_attachments = [f'`<Bad File: {attachment.filename} | File Size: {attachment.size}>`' for attachment in msg.attachments if attachment.size > ATTACHMENT_LIMIT]
+        if bad_attachments:
+            if content:
+                content += '\n'
+            content += '\n'.join(bad_attachments)
 
         if msg.embeds:
             e = msg.embeds[0]
@@ -80,12 +263,16 @@ class Sticky(commands.Cog):
             e = None
             e_dict = None
 
-        msg2 = await self.send_sticky(channel, author, content, e, attachments)
+        msg2 = await self.send_sticky(channel, author, content, e, self.open_attachments(attachments))
 
-        return msg2, content, e_dict
+        return msg2, content, e_dict, attachments
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
+        stickies = self.stickies.get(message.channel.id)
+        if not stickies:
+            return
+
         if not isinstance(message.channel, discord.TextChannel):
             return
 
@@ -103,43 +290,29 @@ class Sticky(commands.Cog):
 
         channel = message.channel
 
-        data = self.db.find({'guild_id':message.guild.id, 'channel_id':channel.id})
-        if not data:
-            return
-
-        async for sticky in data:
+        for sticky in list(stickies):
             if sticky['enabled'] is False:
                 continue
 
             if sticky['counter'] >= (sticky['max_counter']-1):
                 if (calendar.timegm(time.gmtime()) - sticky['msg_time']) > sticky['cooldown']:
+                    # reset before awaiting, so messages arriving mid-repost don't trigger another one
+                    sticky['counter'] = 0
+                    self.dirty_counters[sticky['_id']] = sticky
                     try:
-                        msg = await channel.fetch_message(sticky['msg_id'])
-                        await msg.delete()
+                        await channel.get_partial_message(sticky['msg_id']).delete()
 
                     except discord.NotFound:
-                        if e_dict:= sticky['msg']['embed_dict']:
-                            e = discord.Embed.from_dict(e_dict)
-                        else:
-                            e = None
-
-                        content = sticky['msg']['content']
-                        
                         author = message.guild.get_member(sticky['author']) or await self.bot.fetch_user(sticky['author'])
-                        msg = await self.send_sticky(channel, author, content, e, None)
-                        await self.db.find_one_and_update(
-                            {'guild_id':message.guild.id, 'channel_id':channel.id, 'msg_id':sticky['msg_id']},
-                                {"$set":{
-                                    'msg_id':msg.id,
-                                    'counter':0,
-                                    'msg_time': calendar.timegm(time.gmtime()),
-                                }})
+                        msg = await self.repost_sticky(channel, sticky, author)
+                        await self.update_sticky(sticky, msg_id=msg.id, counter=0, msg_time=calendar.timegm(time.gmtime()))
             else:
-                await self.db.update_many({'guild_id':message.guild.id, 'channel_id':channel.id}, {"$set":{'counter':sticky['counter']+1}})
+                sticky['counter'] += 1
+                self.dirty_counters[sticky['_id']] = sticky
 
     @commands.Cog.listener()
     async def on_raw_message_delete(self, payload: discord.raw_models.RawMessageDeleteEvent):
-        data = await self.db.find_one({'guild_id':payload.guild_id, 'channel_id':payload.channel_id, 'msg_id':payload.message_id})
+        data = self.get_sticky(payload.channel_id, payload.message_id)
 
         if not data:
             return
@@ -148,38 +321,32 @@ class Sticky(commands.Cog):
         guild = self.bot.get_guild(payload.guild_id)
         author = guild.get_member(data['author']) or await self.bot.fetch_user(data['author'])
 
+        if 'attachments' in data['msg']:
+            msg = await self.repost_sticky(channel, data, author)
+            await self.update_sticky(data, msg_id=msg.id, counter=0, msg_time=calendar.timegm(time.gmtime()))
+            return
+
+        # stickies saved before attachments were cached, capture them from the message once
         try:
             msg_check = (payload.cached_message if payload.cached_message else await channel.fetch_message(payload.message_id))
         except discord.NotFound:
-            if e_dict:= data['msg']['embed_dict']:
-                e = discord.Embed.from_dict(e_dict)
-            else:
-                e = None
+            msg_check = await self.repost_sticky(channel, data, author)
 
-            content = data['msg']['content']
-            msg_check = await self.send_sticky(channel, author, content, e, None)
-
-            await self.db.find_one_and_update(
-                {'guild_id':payload.guild_id, 'channel_id':payload.channel_id, 'msg_id':payload.message_id},
-                    {"$set":{
-                        'msg_id':msg_check.id,
-                        'counter':0,
-                        'msg_time': calendar.timegm(time.gmtime()),
-                    }})
+            await self.update_sticky(data, msg_id=msg_check.id, counter=0, msg_time=calendar.timegm(time.gmtime()))
             return
         except discord.Forbidden:
             #await self.db.delete_one({'guild_id':payload.guild_id, 'channel_id':channel.id, 'msg_id':payload.message_id})
             return await self.bot.log_channel.send(f"Failed to fetch sticky message in {channel.mention} due to permissions issue.")
 
-        msg, content, e_dict = await self.check_msg(channel, msg_check, author)
+        msg, content, e_dict, attachments = await self.check_msg(channel, msg_check, author)
 
-        await self.db.find_one_and_update(
-            {'guild_id':payload.guild_id, 'channel_id':payload.channel_id, 'msg_id':payload.message_id},
-                {"$set":{
-                    'msg_id':msg.id,
-                    'counter':0,
-                    'msg_time': calendar.timegm(time.gmtime()),
-                }})
+        await self.update_sticky(
+            data,
+            msg_id=msg.id,
+            counter=0,
+            msg_time=calendar.timegm(time.gmtime()),
+            msg={**data['msg'], 'attachments': attachments},
+        )
 
     @commands.group(name="stick", usage="<counter> <cooldown (default is 30 seconds)>", invoke_without_command=True)
     @checks.has_permissions(PermissionLevel.MOD)
@@ -202,13 +369,14 @@ class Sticky(commands.Cog):
                     msg_check = await ctx.channel.fetch_message(ctx.message.reference.message_id)
                     if not (msg_check and isinstance(msg_check, discord.Message)):
                         return
-                    msg, content, e_dict = await self.check_msg(ctx.channel, msg_check, ctx.message.reference.resolved.author)
-                    await self.db.insert_one({
+                    msg, content, e_dict, attachments = await self.check_msg(ctx.channel, msg_check, ctx.message.reference.resolved.author)
+                    sticky = {
                         'guild_id':ctx.guild.id,
                         'msg_id':msg.id,
                         'msg':{
                             'embed_dict':e_dict,
                             'content':content,
+                            'attachments':attachments,
                             },
                         'channel_id':ctx.channel.id,
                         'author':ctx.message.reference.resolved.author.id,
@@ -217,7 +385,9 @@ class Sticky(commands.Cog):
                         'msg_time': calendar.timegm(time.gmtime()),
                         'cooldown': cooldown,
                         'enabled':True,
-                    })
+                    }
+                    await self.db.insert_one(sticky)
+                    self.stickies.setdefault(ctx.channel.id, []).append(sticky)
                     await ctx.send(embed=discord.Embed(color=self.bot.main_color, description=f"[Sticky Message]({msg.jump_url}) in {ctx.channel.mention}"), delete_after=20)
 
             except commands.BadArgument:
@@ -267,12 +437,14 @@ class Sticky(commands.Cog):
         try:
             if not channel and ctx.message.reference:
                 msg = ctx.message.reference.message_id
-                if data:= await self.db.find_one({'guild_id':ctx.guild.id, 'msg_id':msg}):
-                    await self.db.find_one_and_update({'guild_id':ctx.guild.id, 'msg_id':msg}, {"$set":{'enabled':not data['enabled']}})
-                    description = f"{'Enabled' if not data['enabled'] else 'Disabled'}"
+                if data:= self.get_sticky(ctx.channel.id, msg):
+                    await self.update_sticky(data, enabled=not data['enabled'])
+                    description = f"{'Enabled' if data['enabled'] else 'Disabled'}"
             elif channel:
-                if data:= self.db.find_one({'guild_id':ctx.guild.id, 'channel_id':channel.id}):
+                if data:= self.stickies.get(channel.id):
                     await self.db.update_many({'guild_id':ctx.guild.id, 'channel_id':channel.id}, {"$set":{'enabled':on_off}})
+                    for sticky in data:
+                        sticky['enabled'] = on_off
                     description = f"{'Enabled' if on_off else 'Disabled'}"
             else:
                 return await ctx.send_help(ctx.command)
@@ -301,9 +473,11 @@ class Sticky(commands.Cog):
         try:
             if channel:
                 await self.db.delete_many({'guild_id':ctx.guild.id, 'channel_id':channel.id})
+                self.drop_stickies(channel.id)
             elif ctx.message.reference:
                 msg = ctx.message.reference.message_id
                 await self.db.delete_one({'guild_id':ctx.guild.id, 'msg_id':msg})
+                self.drop_stickies(ctx.channel.id, msg)
             else:
                 return await ctx.send_help(ctx.command)
 